@@ -0,0 +1,229 @@
+"""
+Shared helpers for the ai-training scripts
+JSON I/O with optional orjson, atomic file replacement, file hashing, the merged-model cache, fast tree copies and CPU thread setup
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import platform
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, Set
+
+try:
+    import orjson
+except ImportError:  # Optional speed-up; the stdlib encoder is used otherwise
+    orjson = None
+
+# Merged base+adapter models are reused across runs (and across scripts) from here, keyed by content
+MERGED_CACHE_DIR = Path.home() / ".cache" / "ai-dnd-expo" / "merged"
+
+
+def read_json(path: Path) -> Any:
+    """Load a JSON file, using orjson when it is installed."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_bytes(data: Any) -> bytes:
+    """Serialize to indented JSON bytes, using orjson when it is installed."""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode()
+
+
+def atomic_write(path: Path, data: bytes):
+    """Replace path with data atomically: one write to a sibling temp file, fsync, then rename over."""
+    tmp = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    os.close(fd)
+    os.replace(tmp, path)
+
+
+def write_json(path: Path, data: Any):
+    """Atomically write indented JSON, using orjson when it is installed."""
+    atomic_write(path, json_bytes(data))
+
+
+def append_jsonl(path: Path, record: Dict):
+    """Append one record as a single JSON line."""
+    line = orjson.dumps(record) if orjson else json.dumps(record).encode()
+    with open(path, 'ab') as f:
+        f.write(line + b"\n")
+
+
+def iter_jsonl(path: Path) -> Iterator[Dict]:
+    """Yield the records of a JSON-lines file, skipping blank or truncated lines."""
+    if not path.exists():
+        return
+    loads = orjson.loads if orjson else json.loads
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield loads(line)
+            except ValueError:
+                continue
+
+
+def sha256_file(path: Path) -> str:
+    """SHA-256 of a file without reading it into Python memory."""
+    with open(path, 'rb') as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+
+def dir_names(directory: Path) -> Set[str]:
+    """Names in a directory from a single scandir call (empty if it doesn't exist)."""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def merged_cache_dir(base_model_name: str, adapter_dir: Path) -> Path:
+    """Content-addressed cache location for an adapter merged into its base model."""
+    hasher = hashlib.sha256(base_model_name.encode())
+    for name in ("adapter_config.json", "adapter_model.safetensors", "adapter_model.bin"):
+        adapter_file = adapter_dir / name
+        if adapter_file.exists():
+            with open(adapter_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+    return MERGED_CACHE_DIR / hasher.hexdigest()[:16]
+
+
+def fast_copy(src: str, dst: str) -> str:
+    """copy2 replacement that copies large weight files in kernel space via copy_file_range(2)."""
+    if not hasattr(os, "copy_file_range") or os.path.getsize(src) < (64 << 20):
+        return shutil.copy2(src, dst)
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+        except OSError:
+            # e.g. EXDEV/ENOSYS on older kernels; restart with a large userspace buffer
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, length=16 << 20)
+
+    shutil.copystat(src, dst)
+    return dst
+
+
+def fast_rmtree(path):
+    """Remove a directory tree with rm -rf on POSIX (unlinkat per entry), shutil.rmtree elsewhere."""
+    if os.name == "posix" and subprocess.run(["rm", "-rf", "--", str(path)], capture_output=True).returncode == 0:
+        return
+    shutil.rmtree(path)
+
+
+def parallel_copytree(src: Path, dst: Path, workers: int = 8):
+    """copytree equivalent that creates directories serially, then copies files concurrently."""
+    copies = []
+    dirs = [(str(src), str(dst))]
+    pending = deque(dirs)
+    while pending:
+        src_dir, dst_dir = pending.popleft()
+        os.makedirs(dst_dir, exist_ok=True)
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                target = os.path.join(dst_dir, entry.name)
+                if entry.is_dir():
+                    dirs.append((entry.path, target))
+                    pending.append((entry.path, target))
+                else:
+                    copies.append((entry.path, target))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first copy error, if any
+        list(executor.map(lambda pair: fast_copy(*pair), copies))
+
+    for src_dir, dst_dir in dirs:
+        shutil.copystat(src_dir, dst_dir)
+
+
+def clone_tree(src: Path, dst: Path):
+    """Copy a file or directory tree, using copy-on-write clones where the filesystem supports them."""
+    system = platform.system()
+    if system == "Darwin":
+        cmd = ["cp", "-c", "-R", "-p", str(src), str(dst)]  # clonefile(2) on APFS
+    elif system == "Linux":
+        cmd = ["cp", "-R", "-p", "--reflink=auto", str(src), str(dst)]  # FICLONE on Btrfs/XFS
+    else:
+        cmd = None
+
+    if cmd and subprocess.run(cmd, capture_output=True).returncode == 0:
+        return
+
+    # Cloning isn't available here; clear any partial result and copy normally
+    if dst.is_dir():
+        fast_rmtree(dst)
+    elif dst.exists():
+        dst.unlink()
+
+    if src.is_dir():
+        parallel_copytree(src, dst)
+    else:
+        fast_copy(str(src), str(dst))
+
+
+def physical_cores() -> int:
+    """Number of physical CPU cores (hyperthreads excluded), falling back to logical cores."""
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        pass
+
+    try:
+        cores = set()
+        physical_id = None
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id":
+                    cores.add((physical_id, value.strip()))
+        if cores:
+            return len(cores)
+    except OSError:
+        pass
+
+    return os.cpu_count() or 1
+
+
+def set_cpu_threads():
+    """Run CPU generation with one thread per physical core and a single inter-op thread."""
+    import torch  # Only the model scripts call this; keep torch out of the deploy scripts' startup
+
+    torch.set_num_threads(physical_cores())
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Only settable before the first inter-op parallel work
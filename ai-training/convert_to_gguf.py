@@ -4,45 +4,128 @@ GGUF Conversion Script
 Converts trained HuggingFace models to GGUF format for CactusTTS integration
 """
 
-import json
+import importlib.util
 import os
+import platform
 import shutil
 import subprocess
 import sys
 import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
+
+from _script_utils import dir_names, merged_cache_dir, read_json, sha256_file, write_json
+
+# Keep module-level imports lightweight: torch/transformers/peft/huggingface_hub cost
+# seconds to import and are only imported inside the methods that need them.
+
+# Quantization levels convert_hf_to_gguf.py can emit directly via --outtype
+DIRECT_OUTTYPES = {"Q8_0": "q8_0", "F16": "f16"}
+
+# Approximate bits per weight, used to predict quantized size from the F16 GGUF (16 bits)
+QUANT_BITS_PER_WEIGHT = {
+    "Q8_0": 8.5,
+    "Q6_K": 6.56,
+    "Q5_1": 6.0,
+    "Q5_K_M": 5.69,
+    "Q5_0": 5.5,
+    "Q4_1": 5.0,
+    "Q4_K_M": 4.85,
+    "Q4_0": 4.5,
+    "Q3_K_M": 3.91,
+}
+
+# Per-device quantization candidates (best quality first) and the size they must fit under
+TARGET_PROFILES = {
+    "mobile": {"max_size_mb": 2048, "candidates": ["Q4_K_M", "Q3_K_M"]},
+    "desktop": {"max_size_mb": 8192, "candidates": ["Q6_K", "Q5_K_M", "Q4_K_M"]},
+    "server": {"max_size_mb": None, "candidates": ["Q8_0"]},
+}
+
+# Quantized GGUFs of the plain base model, used when the adapter is shipped separately
+BASE_GGUF_CACHE_DIR = Path.home() / ".cache" / "ai-dnd-expo" / "base-gguf"
+
+
+def _f16_size_mb(model_dir: Path) -> float:
+    """Predict the F16 GGUF size of a HuggingFace model directory from its weight files and dtype."""
+    sizes = {".safetensors": 0, ".bin": 0}
+    with os.scandir(model_dir) as entries:
+        for entry in entries:
+            suffix = os.path.splitext(entry.name)[1]
+            if suffix in sizes:
+                sizes[suffix] += entry.stat().st_size
+
+    # Count one weight format only; fp32 checkpoints (the default without torch_dtype) halve in F16
+    weight_bytes = sizes[".safetensors"] or sizes[".bin"]
+    config_path = model_dir / "config.json"
+    torch_dtype = read_json(config_path).get("torch_dtype") if config_path.exists() else None
+    if torch_dtype in (None, "float32"):
+        weight_bytes /= 2
+    return weight_bytes / (1024 * 1024)
 
 
 class GGUFConverter:
     """Converts HuggingFace models to GGUF format."""
 
-    def __init__(self, model_path: str, output_dir: str = None):
+    def __init__(self, model_path: str, output_dir: str = None, use_cache: bool = True):
         self.model_path = Path(model_path)
         self.output_dir = Path(output_dir) if output_dir else self.model_path.parent / "gguf"
         self.llama_cpp_dir = Path("./llama.cpp")
+        self.base_model_name = "microsoft/DialoGPT-medium"
+        self.use_cache = use_cache
         self.temp_dir = None
 
     def check_llama_cpp(self) -> bool:
         """Check if llama.cpp is available."""
-        if self.llama_cpp_dir.exists():
-            convert_script = self.llama_cpp_dir / "convert_hf_to_gguf.py"
-            quantize_bin = self.llama_cpp_dir / "llama-quantize"
-            build_quantize = self.llama_cpp_dir / "build" / "bin" / "llama-quantize"
-
+        names = dir_names(self.llama_cpp_dir)
+        if names:
             # Check if conversion script exists
-            if not convert_script.exists():
+            if "convert_hf_to_gguf.py" not in names:
                 print("⚠️  llama.cpp conversion script not found")
                 return False
 
             # Check for quantize binary in either location
-            if quantize_bin.exists() or build_quantize.exists():
+            if ("llama-quantize" in names
+                    or "llama-quantize" in dir_names(self.llama_cpp_dir / "build" / "bin")):
                 print("✅ llama.cpp found and ready")
                 return True
 
         print("⚠️  llama.cpp not found or incomplete")
         return False
 
+    def _run_streaming(self, cmd: list) -> None:
+        """Run a command, echoing its output live and keeping only a short tail for errors."""
+        tail = deque(maxlen=200)
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              bufsize=1, text=True) as proc:
+            for line in proc.stdout:
+                sys.stdout.write(line)
+                tail.append(line)
+            returncode = proc.wait()
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output="".join(tail))
+
+    def _conversion_deps_available(self) -> bool:
+        """Check whether the Python packages used by convert_hf_to_gguf.py are importable."""
+        return all(
+            importlib.util.find_spec(name) is not None
+            for name in ("gguf", "numpy", "sentencepiece", "transformers")
+        )
+
+    def _cmake_isa_flags(self) -> List[str]:
+        """CMake flags that tune the llama.cpp build to this host's SIMD support."""
+        # GGML_NATIVE compiles for the host CPU (-march=native), picking up AVX2/AVX-512 where present
+        flags = ["-DGGML_NATIVE=ON"]
+
+        if platform.system() == "Darwin" and platform.machine().lower() == "arm64":
+            # Quantization is CPU-only; NEON + Accelerate cover the hot loops
+            flags += ["-DGGML_METAL=OFF", "-DGGML_ACCELERATE=ON"]
+
+        return flags
+
     def install_llama_cpp(self) -> bool:
         """Install llama.cpp if not available."""
         print("📦 Installing llama.cpp...")
@@ -61,26 +144,38 @@ class GGUFConverter:
             build_dir = self.llama_cpp_dir / "build"
             build_dir.mkdir(exist_ok=True)
 
-            # Configure with CMake
-            subprocess.run([
-                "cmake", "-B", str(build_dir), "-S", str(self.llama_cpp_dir),
-                "-DCMAKE_BUILD_TYPE=Release"
-            ], check=True)
+            # Enable CUDA only when an NVIDIA driver is present
+            if shutil.which("nvidia-smi"):
+                print("🟢 NVIDIA GPU detected, building with CUDA")
+                cuda_flags = ["-DGGML_CUDA=ON", "-DCMAKE_CUDA_ARCHITECTURES=native"]
+            else:
+                cuda_flags = ["-DGGML_CUDA=OFF"]
 
-            # Build
-            subprocess.run([
-                "cmake", "--build", str(build_dir), "--config", "Release", "-j", "4"
-            ], check=True)
+            # Configure with CMake (no curl - models are never downloaded by llama.cpp here)
+            self._run_streaming([
+                "cmake", "-B", str(build_dir), "-S", str(self.llama_cpp_dir),
+                "-DCMAKE_BUILD_TYPE=Release",
+                *cuda_flags,
+                "-DLLAMA_CURL=OFF",
+                *self._cmake_isa_flags()
+            ])
+
+            # Build only the tools this pipeline uses, with every available core
+            self._run_streaming([
+                "cmake", "--build", str(build_dir), "--config", "Release",
+                "--target", "llama-quantize", "llama-gguf-split",
+                "-j", str(os.cpu_count() or 4)
+            ])
 
             # Copy binaries to main directory for easier access
-            quantize_src = build_dir / "bin" / "llama-quantize"
-            quantize_dst = self.llama_cpp_dir / "llama-quantize"
-            if quantize_src.exists():
-                shutil.copy2(quantize_src, quantize_dst)
+            for binary in ("llama-quantize", "llama-gguf-split"):
+                binary_src = build_dir / "bin" / binary
+                if binary_src.exists():
+                    shutil.copy2(binary_src, self.llama_cpp_dir / binary)
 
-            # Install Python requirements
+            # Install Python requirements (skipped when the conversion deps are already present)
             requirements_file = self.llama_cpp_dir / "requirements.txt"
-            if requirements_file.exists():
+            if requirements_file.exists() and not self._conversion_deps_available():
                 print("📦 Installing Python requirements...")
                 subprocess.run([
                     sys.executable, "-m", "pip", "install", "-r", str(requirements_file)
@@ -98,24 +193,33 @@ class GGUFConverter:
 
     def merge_lora_adapter(self) -> Path:
         """Merge LoRA adapter with base model."""
+        cache_dir = merged_cache_dir(self.base_model_name, self.model_path)
+        if self.use_cache and {"config.json", "tokenizer_config.json"} <= dir_names(cache_dir):
+            print(f"♻️  Reusing cached merged model: {cache_dir}")
+            self.temp_dir = None
+            return cache_dir
+
         print("🔗 Merging LoRA adapter with base model...")
 
         try:
+            import torch
             from peft import PeftModel
             from transformers import AutoModelForCausalLM, AutoTokenizer
 
-            # Create temporary directory for merged model
-            self.temp_dir = Path(tempfile.mkdtemp(prefix="merged_model_"))
+            # Stage the merged model next to the cache so it can be moved in atomically
+            cache_dir.parent.mkdir(parents=True, exist_ok=True)
+            self.temp_dir = Path(tempfile.mkdtemp(prefix="merged_model_", dir=cache_dir.parent))
             print(f"📁 Using temporary directory: {self.temp_dir}")
 
             # Load base model
-            base_model_name = "microsoft/DialoGPT-medium"
+            base_model_name = self.base_model_name
             print(f"📥 Loading base model: {base_model_name}")
 
             base_model = AutoModelForCausalLM.from_pretrained(
                 base_model_name,
-                torch_dtype="auto",
-                device_map="cpu",  # Keep on CPU for merging
+                torch_dtype=torch.float16,  # Matches the f16 GGUF written downstream
+                device_map={"": "cpu"},  # Keep on CPU for merging
+                low_cpu_mem_usage=True,
             )
 
             tokenizer = AutoTokenizer.from_pretrained(base_model_name)
@@ -125,15 +229,25 @@ class GGUFConverter:
             model = PeftModel.from_pretrained(base_model, self.model_path)
 
             print("🔀 Merging adapter with base model...")
-            merged_model = model.merge_and_unload()
+            merged_model = model.merge_and_unload().to(torch.float16)
 
             # Save merged model
             print(f"💾 Saving merged model to: {self.temp_dir}")
-            merged_model.save_pretrained(self.temp_dir)
+            merged_model.save_pretrained(
+                self.temp_dir,
+                safe_serialization=True,
+                max_shard_size="2GB",
+            )
             tokenizer.save_pretrained(self.temp_dir)
 
+            # Publish into the cache; it outlives this run, so cleanup() must not remove it
+            if cache_dir.exists():
+                shutil.rmtree(cache_dir)
+            self.temp_dir.rename(cache_dir)
+            self.temp_dir = None
+
             print("✅ Model merged successfully!")
-            return self.temp_dir
+            return cache_dir
 
         except Exception as e:
             print(f"❌ Failed to merge model: {e}")
@@ -141,15 +255,27 @@ class GGUFConverter:
                 shutil.rmtree(self.temp_dir)
             raise
 
-    def convert_to_gguf(self, merged_model_path: Path) -> Path:
+    def _prefetch_model_files(self, model_dir: Path):
+        """Ask the kernel to start reading the merged shards so conversion hits the page cache."""
+        if not hasattr(os, "posix_fadvise"):
+            return
+
+        for shard in model_dir.glob("*.safetensors"):
+            fd = os.open(shard, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def convert_to_gguf(self, merged_model_path: Path, outtype: str = "f16") -> Path:
         """Convert merged model to GGUF format."""
-        print("🔄 Converting to GGUF format...")
+        print(f"🔄 Converting to GGUF format ({outtype})...")
 
         # Create output directory
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
         # Output file path
-        gguf_file = self.output_dir / "model.gguf"
+        gguf_file = self.output_dir / ("model.gguf" if outtype == "f16" else f"model-{outtype}.gguf")
 
         try:
             # Use llama.cpp conversion script
@@ -159,17 +285,11 @@ class GGUFConverter:
                 sys.executable, str(convert_script),
                 str(merged_model_path),
                 "--outfile", str(gguf_file),
-                "--outtype", "f16"
+                "--outtype", outtype
             ]
 
             print(f"🚀 Running conversion: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
-
-            if result.returncode != 0:
-                print(f"❌ Conversion failed:")
-                print(f"STDOUT: {result.stdout}")
-                print(f"STDERR: {result.stderr}")
-                raise subprocess.CalledProcessError(result.returncode, cmd)
+            self._run_streaming(cmd)
 
             print("✅ GGUF conversion completed!")
             return gguf_file
@@ -178,7 +298,8 @@ class GGUFConverter:
             print(f"❌ GGUF conversion failed: {e}")
             raise
 
-    def quantize_model(self, gguf_file: Path, quantization: str = "Q4_K_M") -> Path:
+    def quantize_model(self, gguf_file: Path, quantization: str = "Q4_K_M",
+                       imatrix: Optional[Path] = None) -> Path:
         """Quantize GGUF model for optimal size/performance."""
         print(f"⚡ Quantizing model with {quantization}...")
 
@@ -194,21 +315,18 @@ class GGUFConverter:
             elif not quantize_bin.exists():
                 raise FileNotFoundError("llama-quantize binary not found")
 
-            cmd = [
-                str(quantize_bin),
+            cmd = [str(quantize_bin)]
+            if imatrix:
+                cmd += ["--imatrix", str(imatrix)]
+            cmd += [
                 str(gguf_file),
                 str(quantized_file),
-                quantization
+                quantization,
+                str(os.cpu_count() or 8)  # nthreads
             ]
 
             print(f"🚀 Running quantization: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
-
-            if result.returncode != 0:
-                print(f"❌ Quantization failed:")
-                print(f"STDOUT: {result.stdout}")
-                print(f"STDERR: {result.stderr}")
-                raise subprocess.CalledProcessError(result.returncode, cmd)
+            self._run_streaming(cmd)
 
             print("✅ Model quantization completed!")
             return quantized_file
@@ -217,6 +335,146 @@ class GGUFConverter:
             print(f"❌ Quantization failed: {e}")
             raise
 
+    def _convert_and_quantize(self, model_dir: Path, quantization: str, imatrix: Optional[str] = None,
+                              target: Optional[str] = None) -> Tuple[Path, str]:
+        """Convert a HuggingFace model directory to a quantized GGUF, returning it and the quantization used."""
+        # A target device picks the quantization from the predicted F16 size, before converting
+        if target:
+            quantization = self.select_quantization(_f16_size_mb(model_dir), target)
+
+        if quantization in DIRECT_OUTTYPES:
+            # Single pass: the converter writes the requested type directly
+            return self.convert_to_gguf(model_dir, DIRECT_OUTTYPES[quantization]), quantization
+
+        # Convert to GGUF
+        gguf_file = self.convert_to_gguf(model_dir)
+
+        # Quantize model, then drop the intermediate F16 GGUF
+        quantized_file = self.quantize_model(
+            gguf_file, quantization, Path(imatrix) if imatrix else None
+        )
+        gguf_file.unlink(missing_ok=True)
+        return quantized_file, quantization
+
+    def convert_base_model(self, quantization: str, imatrix: Optional[str] = None,
+                           target: Optional[str] = None) -> Tuple[Path, str]:
+        """Quantize the plain base model to GGUF once per base model and quantization."""
+        from huggingface_hub import list_repo_files, snapshot_download
+
+        cache_name = self.base_model_name.replace("/", "--")
+        if not target:
+            cache_file = BASE_GGUF_CACHE_DIR / f"{cache_name}-{quantization.lower()}.gguf"
+            if self.use_cache and cache_file.exists():
+                print(f"♻️  Reusing cached base model GGUF: {cache_file}")
+                return cache_file, quantization
+
+        # Repos often publish both formats; fetch one copy of the weights, preferring safetensors
+        try:
+            repo_files = list_repo_files(self.base_model_name)
+            has_safetensors = any(name.endswith(".safetensors") for name in repo_files)
+            weight_patterns = ["*.safetensors"] if has_safetensors else ["pytorch_model*.bin"]
+        except Exception as e:
+            # Offline or hub unreachable; snapshot_download falls back to what is already cached
+            print(f"⚠️  Could not list files for {self.base_model_name}: {e}")
+            weight_patterns = ["*.safetensors", "pytorch_model*.bin"]
+
+        print(f"📥 Fetching base model: {self.base_model_name}")
+        base_model_dir = Path(snapshot_download(
+            self.base_model_name,
+            allow_patterns=["*.json", "*.txt", "*.model"] + weight_patterns,
+        ))
+
+        gguf_file, quantization = self._convert_and_quantize(base_model_dir, quantization, imatrix, target)
+
+        cache_file = BASE_GGUF_CACHE_DIR / f"{cache_name}-{quantization.lower()}.gguf"
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(gguf_file), cache_file)
+        return cache_file, quantization
+
+    def convert_lora_to_gguf(self) -> Path:
+        """Convert the LoRA adapter to a GGUF adapter that llama.cpp applies at load time."""
+        from huggingface_hub import snapshot_download
+
+        print("🔄 Converting LoRA adapter to GGUF...")
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        adapter_gguf = self.output_dir / "adapter.gguf"
+
+        # Only the base config/tokenizer are needed to describe the adapter's target
+        base_model_dir = snapshot_download(self.base_model_name, allow_patterns=["*.json", "*.txt"])
+
+        cmd = [
+            sys.executable, str(self.llama_cpp_dir / "convert_lora_to_gguf.py"),
+            "--base", str(base_model_dir),
+            "--outfile", str(adapter_gguf),
+            "--outtype", "f16",
+            str(self.model_path)
+        ]
+
+        print(f"🚀 Running adapter conversion: {' '.join(cmd)}")
+        self._run_streaming(cmd)
+
+        print("✅ LoRA adapter conversion completed!")
+        return adapter_gguf
+
+    def split_gguf_model(self, gguf_file: Path, split_threshold_mb: int = 1800) -> List[Path]:
+        """Split a GGUF model into shards no larger than split_threshold_mb."""
+        print(f"✂️  Splitting model into shards of at most {split_threshold_mb} MB...")
+
+        split_bin = self.llama_cpp_dir / "build" / "bin" / "llama-gguf-split"
+        if not split_bin.exists():
+            split_bin = self.llama_cpp_dir / "llama-gguf-split"
+        if not split_bin.exists():
+            print("⚠️  llama-gguf-split binary not found, keeping the unsplit model")
+            return [gguf_file]
+
+        # Shards are written as <prefix>-00001-of-0000N.gguf
+        shard_prefix = gguf_file.with_suffix("")
+        cmd = [
+            str(split_bin), "--split",
+            "--split-max-size", f"{split_threshold_mb}M",
+            str(gguf_file),
+            str(shard_prefix)
+        ]
+
+        print(f"🚀 Running split: {' '.join(cmd)}")
+        self._run_streaming(cmd)
+        gguf_file.unlink(missing_ok=True)
+
+        shards = sorted(gguf_file.parent.glob(f"{shard_prefix.name}-*-of-*.gguf"))
+        print(f"✅ Model split into {len(shards)} shards")
+        return shards
+
+    def _probe_gguf_info(self, gguf_file: Path) -> str:
+        """Read GGUF header info with llama.cpp; only metadata is read, so this is quick."""
+        info_cmd = [str(self.llama_cpp_dir / "llama-ls"), str(gguf_file)]
+
+        try:
+            result = subprocess.run(info_cmd, capture_output=True, text=True, timeout=5)
+            return result.stdout if result.returncode == 0 else "Info not available"
+        except (subprocess.TimeoutExpired, FileNotFoundError):
+            return "Info not available"
+
+    def select_quantization(self, f16_size_mb: float, target: str) -> str:
+        """Pick the best-quality quantization predicted to fit the target device."""
+        profile = TARGET_PROFILES[target]
+        max_size_mb = profile["max_size_mb"]
+
+        for quantization in profile["candidates"]:
+            predicted_mb = f16_size_mb * QUANT_BITS_PER_WEIGHT[quantization] / 16
+            if max_size_mb is None or predicted_mb < max_size_mb:
+                print(f"🎯 Target '{target}': using {quantization} (~{predicted_mb:.0f} MB predicted)")
+                return quantization
+
+        # Nothing fits; fall back to the smallest candidate
+        quantization = profile["candidates"][-1]
+        print(f"⚠️  No quantization predicted to fit {max_size_mb} MB, using {quantization}")
+        return quantization
+
+    def validate_gguf_models(self, gguf_files: List[Path]) -> List[Dict[str, Any]]:
+        """Validate several GGUF models concurrently."""
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            return list(executor.map(self.validate_gguf_model, gguf_files))
+
     def validate_gguf_model(self, gguf_file: Path) -> Dict[str, Any]:
         """Validate the generated GGUF model."""
         print("🔍 Validating GGUF model...")
@@ -226,28 +484,24 @@ class GGUFConverter:
             if not gguf_file.exists():
                 return {"valid": False, "error": "GGUF file not found"}
 
+            # Shards are validated concurrently by validate_gguf_models; each file runs serially here
             file_size = gguf_file.stat().st_size
+            model_info = self._probe_gguf_info(gguf_file)
+            sha256 = sha256_file(gguf_file)
+
             size_mb = file_size / (1024 * 1024)
 
             # Check if under mobile limit (2GB)
             mobile_limit_mb = 2048
             under_limit = size_mb < mobile_limit_mb
 
-            # Try to get model info using llama.cpp
-            info_cmd = [str(self.llama_cpp_dir / "llama-ls"), str(gguf_file)]
-
-            try:
-                result = subprocess.run(info_cmd, capture_output=True, text=True, timeout=30)
-                model_info = result.stdout if result.returncode == 0 else "Info not available"
-            except (subprocess.TimeoutExpired, FileNotFoundError):
-                model_info = "Info not available"
-
             validation_result = {
                 "valid": True,
                 "file_path": str(gguf_file),
                 "size_mb": round(size_mb, 2),
                 "under_mobile_limit": under_limit,
                 "mobile_limit_mb": mobile_limit_mb,
+                "sha256": sha256,
                 "model_info": model_info
             }
 
@@ -257,15 +511,16 @@ class GGUFConverter:
         except Exception as e:
             return {"valid": False, "error": str(e)}
 
-    def generate_cactus_config(self, gguf_file: Path) -> Dict[str, Any]:
+    def generate_cactus_config(self, gguf_file: Path, quantization: str = "Q4_K_M",
+                               lora_adapter: Optional[Path] = None,
+                               shards: Optional[List[Path]] = None) -> Dict[str, Any]:
         """Generate CactusTTS configuration for the GGUF model."""
         print("⚙️  Generating CactusTTS configuration...")
 
         # Load original cactus config if available
         original_config_path = self.model_path / "cactus_config.json"
         if original_config_path.exists():
-            with open(original_config_path, 'r') as f:
-                base_config = json.load(f)
+            base_config = read_json(original_config_path)
         else:
             base_config = {}
 
@@ -275,7 +530,7 @@ class GGUFConverter:
                 "name": f"{base_config.get('model', {}).get('name', 'dnd_model')}_gguf",
                 "type": "gguf",
                 "path": f"./assets/models/{gguf_file.name}",
-                "quantization": "q4_k_m",
+                "quantization": quantization.lower(),
                 "context_length": base_config.get('model', {}).get('context_length', 2048)
             },
             "system_prompt": base_config.get('system_prompt',
@@ -295,14 +550,26 @@ class GGUFConverter:
             "gguf_info": {
                 "original_model": str(self.model_path),
                 "conversion_date": str(Path().cwd()),
-                "file_size_mb": round(gguf_file.stat().st_size / (1024 * 1024), 2)
+                "file_size_mb": round(
+                    sum(f.stat().st_size for f in (shards or [gguf_file])) / (1024 * 1024), 2
+                )
             }
         }
 
+        # llama.cpp loads a split model from its first shard and finds the rest itself
+        if shards:
+            gguf_config["model"]["shards"] = [f"./assets/models/{shard.name}" for shard in shards]
+
+        # The base model and the adapter are loaded together by CactusTTS
+        if lora_adapter:
+            gguf_config["lora_adapter"] = {
+                "path": f"./assets/models/{lora_adapter.name}",
+                "file_size_mb": round(lora_adapter.stat().st_size / (1024 * 1024), 2)
+            }
+
         # Save config
         config_file = gguf_file.parent / "cactus_gguf_config.json"
-        with open(config_file, 'w') as f:
-            json.dump(gguf_config, f, indent=2)
+        write_json(config_file, gguf_config)
 
         print(f"✅ Configuration saved to: {config_file}")
         return gguf_config
@@ -313,7 +580,9 @@ class GGUFConverter:
             print(f"🧹 Cleaning up temporary files: {self.temp_dir}")
             shutil.rmtree(self.temp_dir)
 
-    def convert(self, quantization: str = "Q4_K_M") -> Dict[str, Any]:
+    def convert(self, quantization: str = "Q4_K_M", imatrix: Optional[str] = None,
+                target: Optional[str] = None, keep_adapter: bool = False,
+                split_threshold_mb: Optional[int] = 1800) -> Dict[str, Any]:
         """Run the complete conversion process."""
         print("🔄 Starting GGUF Conversion Process")
         print("=" * 50)
@@ -324,24 +593,59 @@ class GGUFConverter:
                 if not self.install_llama_cpp():
                     return {"success": False, "error": "Failed to install llama.cpp"}
 
-            # Merge LoRA adapter
-            merged_model_path = self.merge_lora_adapter()
-
-            # Convert to GGUF
-            gguf_file = self.convert_to_gguf(merged_model_path)
-
-            # Quantize model
-            quantized_file = self.quantize_model(gguf_file, quantization)
+            adapter_file = None
+            if keep_adapter:
+                # Ship the untouched base model plus a GGUF LoRA instead of merging
+                base_file, quantization = self.convert_base_model(quantization, imatrix, target)
+                quantized_file = self.output_dir / f"base-{quantization.lower()}.gguf"
+                quantized_file.unlink(missing_ok=True)
+                try:
+                    os.link(base_file, quantized_file)
+                except OSError:
+                    shutil.copy2(base_file, quantized_file)
+
+                adapter_file = self.convert_lora_to_gguf()
+            else:
+                # Merge LoRA adapter
+                merged_model_path = self.merge_lora_adapter()
+                self._prefetch_model_files(merged_model_path)
+
+                quantized_file, quantization = self._convert_and_quantize(
+                    merged_model_path, quantization, imatrix, target
+                )
+
+            # Split oversized models instead of making the user re-run with a smaller quantization
+            shards = None
+            size_mb = quantized_file.stat().st_size / (1024 * 1024)
+            if split_threshold_mb and size_mb >= split_threshold_mb:
+                shards = self.split_gguf_model(quantized_file, split_threshold_mb)
+                quantized_file = shards[0]
+                if len(shards) == 1:
+                    shards = None
 
             # Validate result
-            validation = self.validate_gguf_model(quantized_file)
+            if shards:
+                shard_validations = self.validate_gguf_models(shards)
+                validation = {
+                    "valid": all(v["valid"] for v in shard_validations),
+                    "file_path": str(quantized_file),
+                    "size_mb": round(sum(v.get("size_mb", 0) for v in shard_validations), 2),
+                    "under_mobile_limit": all(v.get("under_mobile_limit") for v in shard_validations),
+                    "mobile_limit_mb": shard_validations[0].get("mobile_limit_mb"),
+                    "shards": shard_validations
+                }
+            else:
+                validation = self.validate_gguf_model(quantized_file)
 
             # Generate Cactus config
-            cactus_config = self.generate_cactus_config(quantized_file)
+            cactus_config = self.generate_cactus_config(quantized_file, quantization, adapter_file, shards)
 
             result = {
                 "success": True,
                 "gguf_file": str(quantized_file),
+                "lora_adapter": str(adapter_file) if adapter_file else None,
+                "shards": [str(shard) for shard in shards] if shards else None,
+                "quantization": quantization,
                 "validation": validation,
                 "cactus_config": cactus_config,
                 "output_dir": str(self.output_dir)
@@ -351,6 +655,11 @@ class GGUFConverter:
             print("🎉 GGUF CONVERSION COMPLETED!")
             print("=" * 60)
             print(f"📁 GGUF Model: {quantized_file}")
+            if shards:
+                print(f"✂️  Shards: {len(shards)}")
+            if adapter_file:
+                print(f"🧩 LoRA Adapter: {adapter_file}")
+            print(f"⚡ Quantization: {quantization}")
             print(f"📦 Size: {validation.get('size_mb', 0)} MB")
             print(f"📱 Mobile Compatible: {'✅' if validation.get('under_mobile_limit') else '❌'}")
             print(f"⚙️  Config: {self.output_dir}/cactus_gguf_config.json")
@@ -375,8 +684,18 @@ def main():
                        help="Path to trained model directory")
     parser.add_argument("--output", help="Output directory for GGUF files")
     parser.add_argument("--quantization", default="Q4_K_M",
-                       choices=["Q4_0", "Q4_1", "Q5_0", "Q5_1", "Q8_0", "Q4_K_M", "Q5_K_M"],
+                       choices=["Q4_0", "Q4_1", "Q5_0", "Q5_1", "Q8_0", "Q3_K_M", "Q4_K_M", "Q5_K_M", "Q6_K", "F16"],
                        help="Quantization level")
+    parser.add_argument("--target", choices=sorted(TARGET_PROFILES),
+                       help="Target device class; picks the quantization automatically (overrides --quantization)")
+    parser.add_argument("--imatrix",
+                       help="Importance matrix file used to calibrate K-quant quantization")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="Rebuild cached merged models and base model GGUFs instead of reusing them")
+    parser.add_argument("--keep-adapter", action="store_true",
+                       help="Ship the quantized base model and a GGUF LoRA adapter instead of merging")
+    parser.add_argument("--split-threshold-mb", type=int, default=1800,
+                       help="Split GGUF output into shards of this size when larger (mobile=1800, watch=400, 0 disables)")
 
     args = parser.parse_args()
 
@@ -388,8 +707,9 @@ def main():
         return False
 
     # Run conversion
-    converter = GGUFConverter(args.model, args.output)
-    result = converter.convert(args.quantization)
+    converter = GGUFConverter(args.model, args.output, use_cache=not args.no_cache)
+    result = converter.convert(args.quantization, args.imatrix, args.target, args.keep_adapter,
+                               args.split_threshold_mb)
 
     if result["success"]:
         print("\n🎊 GGUF conversion completed successfully!")
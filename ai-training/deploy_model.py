@@ -4,12 +4,28 @@ Model Deployment Script
 Automatically deploys trained models to the assets/models directory and generates integration configuration
 """
 
-import json
 import os
 import shutil
 import sys
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
+
+from _script_utils import atomic_write, dir_names, fast_copy, read_json, sha256_file, write_json
+
+# Deployment never touches ML code; keep module-level imports lightweight so startup
+# stays fast (do not import torch/transformers/peft here).
+
+
+def _replacing(copy_function):
+    """Wrap a copytree copy_function so it removes an existing destination file first."""
+    def copy(src: str, dst: str) -> str:
+        # A redeployed file may be a hardlink into the source model; never write through it
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        return copy_function(src, dst)
+    return copy
 
 
 class ModelDeployer:
@@ -21,21 +37,41 @@ class ModelDeployer:
         self.assets_dir = self.script_dir.parent / "assets/models"
         self.target_name = target_name or "custom-dnd-trained-model"
         self.target_dir = self.assets_dir / self.target_name
+        self._scan_cache: Optional[Tuple[Path, Dict[str, int]]] = None
+
+    def _scan_target(self) -> Dict[str, int]:
+        """Map every file under the target directory (relative path) to its size, walking it only once."""
+        if self._scan_cache is None or self._scan_cache[0] != self.target_dir:
+            files = {}
+            pending = [self.target_dir]
+            while pending:
+                directory = pending.pop()
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(Path(entry.path))
+                        elif entry.is_file(follow_symlinks=False):
+                            relative = Path(entry.path).relative_to(self.target_dir).as_posix()
+                            files[relative] = entry.stat(follow_symlinks=False).st_size
+            self._scan_cache = (self.target_dir, files)
+        return self._scan_cache[1]
+
+    def _record_written(self, path: Path):
+        """Keep the scan cache in step with files written after the scan."""
+        if self._scan_cache is not None and self._scan_cache[0] == self.target_dir:
+            self._scan_cache[1][path.relative_to(self.target_dir).as_posix()] = path.stat().st_size
 
     def validate_source_model(self) -> bool:
         """Validate that the source model exists and is ready for deployment."""
-        if not self.model_source.exists():
+        source_names = dir_names(self.model_source)
+        if not source_names:
             print(f"❌ Source model not found: {self.model_source}")
             print("Run model training and conversion first")
             return False
 
         # Check for required files
         required_files = ["config.json", "tokenizer.json"]
-        missing_files = []
-
-        for file in required_files:
-            if not (self.model_source / file).exists():
-                missing_files.append(file)
+        missing_files = [file for file in required_files if file not in source_names]
 
         if missing_files:
             print(f"⚠️  Missing required files: {missing_files}")
@@ -54,6 +90,7 @@ class ModelDeployer:
 
             # Create target directory
             self.target_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_cache = None
             print(f"📁 Created target directory: {self.target_dir}")
             return True
 
@@ -66,16 +103,20 @@ class ModelDeployer:
         try:
             print(f"📋 Copying model files from {self.model_source} to {self.target_dir}")
 
-            # Copy all files from source to target
-            for item in self.model_source.iterdir():
-                if item.is_file():
-                    target_file = self.target_dir / item.name
-                    shutil.copy2(item, target_file)
-                    print(f"   ✅ Copied: {item.name}")
-                elif item.is_dir():
-                    target_subdir = self.target_dir / item.name
-                    shutil.copytree(item, target_subdir)
-                    print(f"   ✅ Copied directory: {item.name}")
+            # Hardlink when source and target share a filesystem, otherwise copy
+            same_device = os.stat(self.model_source).st_dev == os.stat(self.assets_dir).st_dev
+            if same_device:
+                try:
+                    shutil.copytree(self.model_source, self.target_dir,
+                                    dirs_exist_ok=True, copy_function=_replacing(os.link))
+                    print("✅ Model files linked successfully")
+                    return True
+                except OSError as e:
+                    # Files linked so far are unlinked again before each copy below
+                    print(f"⚠️  Hardlinking failed ({e}), falling back to copying")
+
+            shutil.copytree(self.model_source, self.target_dir,
+                            dirs_exist_ok=True, copy_function=_replacing(fast_copy))
 
             print("✅ Model files copied successfully")
             return True
@@ -89,15 +130,16 @@ class ModelDeployer:
         # Load source config if available
         source_config_path = self.script_dir / "trained_models/gguf/cactus_config.json"
         if source_config_path.exists():
-            with open(source_config_path, 'r') as f:
-                source_config = json.load(f)
+            source_config = read_json(source_config_path)
         else:
             source_config = {}
 
-        # Calculate model size
-        model_files = list(self.target_dir.glob("*.safetensors")) + list(self.target_dir.glob("*.bin"))
-        total_size = sum(f.stat().st_size for f in model_files)
+        # Calculate model size and per-file checksums so CactusTTS can verify the weights
+        target_files = self._scan_target()
+        weight_files = sorted(name for name in target_files if name.endswith((".safetensors", ".bin", ".gguf")))
+        total_size = sum(target_files[name] for name in weight_files)
         size_mb = total_size / (1024 * 1024)
+        sha256 = {name: sha256_file(self.target_dir / name) for name in weight_files}
 
         # Generate deployment config
         deployment_config = {
@@ -106,6 +148,7 @@ class ModelDeployer:
                 "type": "huggingface_merged",
                 "format": "safetensors",
                 "size_mb": round(size_mb, 2),
+                "sha256": sha256,
                 "deployment_date": str(Path().cwd()),
                 "source": str(self.model_source),
                 "target": str(self.target_dir)
@@ -130,8 +173,8 @@ class ModelDeployer:
         """Save the deployment configuration."""
         try:
             config_file = self.target_dir / "deployment_config.json"
-            with open(config_file, 'w') as f:
-                json.dump(config, f, indent=2)
+            write_json(config_file, config)
+            self._record_written(config_file)
 
             print(f"✅ Deployment config saved: {config_file}")
             return True
@@ -172,9 +215,10 @@ const loadCustomModel = async () => {{
         try:
             integration_code = self.generate_cactus_integration_example(config)
 
+            # Replace rather than write in place: files in the target may share inodes with the source
             example_file = self.target_dir / "integration-example.ts"
-            with open(example_file, 'w') as f:
-                f.write(integration_code)
+            atomic_write(example_file, integration_code.encode())
+            self._record_written(example_file)
 
             print(f"✅ Integration example saved: {example_file}")
             return True
@@ -194,15 +238,15 @@ const loadCustomModel = async () => {{
 
         if validation_results["target_exists"]:
             # Check files
-            for file in self.target_dir.iterdir():
-                if file.is_file():
-                    validation_results["files_present"].append(file.name)
-                    validation_results["total_size_mb"] += file.stat().st_size / (1024 * 1024)
+            target_files = self._scan_target()
+            for name, size in target_files.items():
+                validation_results["files_present"].append(name)
+                validation_results["total_size_mb"] += size / (1024 * 1024)
 
             # Check for config files
             config_files = ["config.json", "tokenizer.json", "deployment_config.json", "integration-example.ts"]
             for config_file in config_files:
-                if (self.target_dir / config_file).exists():
+                if config_file in target_files:
                     validation_results["config_files"].append(config_file)
 
         validation_results["total_size_mb"] = round(validation_results["total_size_mb"], 2)
@@ -4,12 +4,29 @@ Deploy Trained Model to CactusTTS
 Copies trained models to assets/models and provides integration configuration
 """
 
-import json
 import os
-import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional
+from string import Template
+from typing import Any, Dict, List, Optional, Tuple
+
+from _script_utils import atomic_write, clone_tree, fast_rmtree, json_bytes, read_json, write_json
+
+# TypeScript example written next to each deployed model; ${relative_path} is filled in per deploy
+_CACTUS_TEMPLATE = Template(Path(__file__).with_suffix('.ts.tmpl').read_text())
+
+
+def _scan_model_dir(model_dir: Path) -> Tuple[List[str], List[str], int]:
+    """List a model directory once: all names, weight file names, and total weight size in bytes."""
+    all_names, weight_names, total_size = [], [], 0
+    with os.scandir(model_dir) as entries:
+        for entry in entries:
+            all_names.append(entry.name)
+            if entry.name.endswith((".safetensors", ".bin")) and entry.is_file():
+                weight_names.append(entry.name)
+                total_size += entry.stat().st_size
+    return all_names, sorted(weight_names), total_size
 
 
 class CactusDeployment:
@@ -26,6 +43,8 @@ class CactusDeployment:
         self.model_source = Path(model_source)
 
         self.cactus_ts_path = self.project_root / "components" / "cactus.ts"
+        self.model_scan: Optional[Tuple[List[str], List[str], int]] = None
+        self._cwd = Path.cwd()
 
     def check_model_source(self) -> bool:
         """Check if the model source exists."""
@@ -69,21 +88,21 @@ class CactusDeployment:
             # Remove existing model if present
             if target_dir.exists():
                 print(f"🗑️  Removing existing model: {target_dir}")
-                shutil.rmtree(target_dir)
+                fast_rmtree(target_dir)
 
             # Copy model files
             print(f"📦 Copying model from {self.model_source} to {target_dir}")
-            shutil.copytree(self.model_source, target_dir)
+            clone_tree(self.model_source, target_dir)
 
-            # Get model size info
-            model_files = list(target_dir.glob("*.safetensors")) + list(target_dir.glob("*.bin"))
-            total_size = sum(f.stat().st_size for f in model_files)
+            # Get model size info (reused by generate_integration_config)
+            self.model_scan = _scan_model_dir(target_dir)
+            all_names, _, total_size = self.model_scan
             size_mb = total_size / (1024 * 1024)
 
             print(f"✅ Model copied successfully!")
             print(f"   Location: {target_dir}")
             print(f"   Size: {size_mb:.2f} MB")
-            print(f"   Files: {len(list(target_dir.iterdir()))} files")
+            print(f"   Files: {len(all_names)} files")
 
             return target_dir
 
@@ -91,32 +110,32 @@ class CactusDeployment:
             print(f"❌ Failed to copy model: {e}")
             return None
 
-    def generate_integration_config(self, model_dir: Path) -> Dict[str, Any]:
+    def generate_integration_config(self, model_dir: Path, relative_dir: Optional[Path] = None) -> Dict[str, Any]:
         """Generate integration configuration for cactus.ts."""
 
         # Load the original cactus config if available
         config_source = self.script_dir / "trained_models" / "gguf" / "cactus_config.json"
         if config_source.exists():
-            with open(config_source, 'r') as f:
-                base_config = json.load(f)
+            base_config = read_json(config_source)
         else:
             base_config = {}
 
         # Create relative path from project root
-        relative_model_path = f"./{model_dir.relative_to(self.project_root)}"
+        relative_model_path = f"./{relative_dir or model_dir.relative_to(self.project_root)}"
+        _, weight_names, _ = self.model_scan or _scan_model_dir(model_dir)
 
         integration_config = {
             "deployment_info": {
                 "model_name": "custom-dnd-model",
                 "model_type": "huggingface_transformers",
-                "deployment_date": str(Path().cwd()),
+                "deployment_date": str(self._cwd),
                 "source_model": str(self.model_source)
             },
             "cactus_integration": {
                 "model_path": relative_model_path,
                 "config_file": f"{relative_model_path}/config.json",
                 "tokenizer_file": f"{relative_model_path}/tokenizer.json",
-                "model_files": [f.name for f in model_dir.glob("*.safetensors")] + [f.name for f in model_dir.glob("*.bin")]
+                "model_files": weight_names
             },
             "usage_instructions": {
                 "loading": "Use transformers.AutoModelForCausalLM.from_pretrained(model_path)",
@@ -131,97 +150,30 @@ class CactusDeployment:
 
         return integration_config
 
-    def create_cactus_integration_example(self, model_dir: Path) -> str:
+    def create_cactus_integration_example(self, model_dir: Path, relative_dir: Optional[Path] = None) -> str:
         """Create example code for integrating with cactus.ts."""
 
-        relative_path = f"./{model_dir.relative_to(self.project_root)}"
-
-        example_code = f'''
-// Example integration with your custom D&D model
-// Add this to your cactus.ts or create a new custom model manager
-
-import {{ AutoModelForCausalLM, AutoTokenizer }} from '@fugood/transformers';
-
-class CustomDnDModel {{
-    private model: any = null;
-    private tokenizer: any = null;
-    private isInitialized = false;
-
-    async initialize(): Promise<void> {{
-        if (this.isInitialized) return;
-
-        try {{
-            // Load your custom trained model
-            this.tokenizer = await AutoTokenizer.from_pretrained('{relative_path}');
-            this.model = await AutoModelForCausalLM.from_pretrained('{relative_path}');
-
-            this.isInitialized = true;
-            console.log('✅ Custom D&D model loaded successfully!');
-        }} catch (error) {{
-            console.error('❌ Failed to load custom D&D model:', error);
-            throw error;
-        }}
-    }}
-
-    async generateResponse(prompt: string): Promise<string> {{
-        if (!this.isInitialized) {{
-            await this.initialize();
-        }}
-
-        try {{
-            const inputs = await this.tokenizer.encode(prompt);
-            const outputs = await this.model.generate(inputs, {{
-                max_length: inputs.length + 128,
-                temperature: 0.7,
-                top_p: 0.9,
-                do_sample: true,
-            }});
-
-            const response = await this.tokenizer.decode(outputs[0].slice(inputs.length));
-            return response.trim();
-        }} catch (error) {{
-            console.error('❌ Generation failed:', error);
-            throw error;
-        }}
-    }}
-
-    async generateDnDResponse(userMessage: string): Promise<string> {{
-        const systemPrompt = "You are a Dungeon Master assistant for D&D 5e. You help with gameplay, rules, and story generation. Use tool calls when needed for game mechanics.";
-        const fullPrompt = `System: ${{systemPrompt}}\\nUser: ${{userMessage}}\\nDM:`;
-
-        return await this.generateResponse(fullPrompt);
-    }}
-}}
-
-// Usage example:
-// const customModel = new CustomDnDModel();
-// const response = await customModel.generateDnDResponse("I want to roll for perception");
-'''
-
-        return example_code
-
-    def save_integration_files(self, model_dir: Path, config: Dict[str, Any]) -> bool:
+        relative_path = f"./{relative_dir or model_dir.relative_to(self.project_root)}"
+        return _CACTUS_TEMPLATE.substitute(relative_path=relative_path)
+
+    def save_integration_files(self, model_dir: Path, config: Dict[str, Any],
+                               relative_dir: Optional[Path] = None) -> bool:
         """Save integration configuration and example files."""
         try:
-            # Save integration config
-            config_file = model_dir / "cactus_integration.json"
-            with open(config_file, 'w') as f:
-                json.dump(config, f, indent=2)
+            relative_dir = relative_dir or model_dir.relative_to(self.project_root)
 
-            # Save example code
-            example_code = self.create_cactus_integration_example(model_dir)
+            config_file = model_dir / "cactus_integration.json"
             example_file = model_dir / "integration_example.ts"
-            with open(example_file, 'w') as f:
-                f.write(example_code)
+            deployment_file = model_dir / "deployment_info.json"
 
-            # Save deployment info
+            # Deployment info
             deployment_info = {
-                "deployment_date": str(Path().cwd()),
+                "deployment_date": str(self._cwd),
                 "model_location": str(model_dir),
-                "relative_path": f"./{model_dir.relative_to(self.project_root)}",
+                "relative_path": f"./{relative_dir}",
                 "integration_files": [
-                    str(config_file.relative_to(self.project_root)),
-                    str(example_file.relative_to(self.project_root))
+                    str(relative_dir / config_file.name),
+                    str(relative_dir / example_file.name)
                 ],
                 "usage_instructions": [
                     "1. Import the example code into your project",
@@ -231,9 +183,16 @@ class CustomDnDModel {{
                 ]
             }
 
-            deployment_file = model_dir / "deployment_info.json"
-            with open(deployment_file, 'w') as f:
-                json.dump(deployment_info, f, indent=2)
+            # Serialize everything up front, then issue the three writes concurrently
+            contents = {
+                config_file: json_bytes(config),
+                example_file: self.create_cactus_integration_example(model_dir, relative_dir).encode(),
+                deployment_file: json_bytes(deployment_info),
+            }
+            with ThreadPoolExecutor(max_workers=len(contents)) as executor:
+                futures = [executor.submit(atomic_write, path, data) for path, data in contents.items()]
+                for future in futures:
+                    future.result()  # re-raise any write error
 
             print(f"✅ Integration files saved:")
             print(f"   Config: {config_file}")
@@ -264,17 +223,20 @@ class CustomDnDModel {{
         if not model_dir:
             return {"success": False, "error": "Failed to copy model"}
 
+        # Computed once and shared by the config, example and deployment info
+        relative_dir = model_dir.relative_to(self.project_root)
+
         # Generate integration config
-        config = self.generate_integration_config(model_dir)
+        config = self.generate_integration_config(model_dir, relative_dir)
 
         # Save integration files
-        if not self.save_integration_files(model_dir, config):
+        if not self.save_integration_files(model_dir, config, relative_dir):
             return {"success": False, "error": "Failed to save integration files"}
 
         result = {
             "success": True,
             "model_location": str(model_dir),
-            "relative_path": f"./{model_dir.relative_to(self.project_root)}",
+            "relative_path": f"./{relative_dir}",
             "integration_config": config,
             "files_created": [
                 f"{model_dir}/cactus_integration.json",
@@ -318,8 +280,7 @@ def main():
 
         # Save result for reference
         result_file = deployer.script_dir / "deployment_result.json"
-        with open(result_file, 'w') as f:
-            json.dump(result, f, indent=2)
+        write_json(result_file, result)
         print(f"📋 Deployment details saved to: {result_file}")
 
         return True
@@ -5,12 +5,65 @@ Automatically detects updated training data and performs incremental training
 """
 
 import hashlib
-import json
+import heapq
+import mmap
 import os
-import shutil
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from stat import S_ISREG
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from _script_utils import append_jsonl, clone_tree, fast_rmtree, iter_jsonl, read_json, write_json
+
+# Bump when get_data_hash changes; metadata without it holds the original sha256 of contents + paths
+DATA_HASH_FORMAT = 2
+
+
+def _iter_md(root: Path) -> Iterator[os.DirEntry]:
+    """Yield every markdown file under root, using dirent types instead of per-entry stat()."""
+    pending = deque([root])
+    while pending:
+        with os.scandir(pending.popleft()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith('.md') and entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+def _iter_md_stats(root: Path) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield (relative POSIX path, stat) for every markdown file under root, stat'ing relative to each directory fd."""
+    if not hasattr(os, "fwalk"):  # Windows
+        for entry in _iter_md(root):
+            yield Path(entry.path).relative_to(root).as_posix(), entry.stat(follow_symlinks=False)
+        return
+
+    for dirpath, _, filenames, dirfd in os.fwalk(root):
+        rel_dir = Path(dirpath).relative_to(root).as_posix()
+        for name in filenames:
+            if not name.endswith('.md'):
+                continue
+            stat = os.stat(name, dir_fd=dirfd, follow_symlinks=False)
+            if S_ISREG(stat.st_mode):
+                yield (name if rel_dir == '.' else f"{rel_dir}/{name}"), stat
+
+
+def _blake2b_of(path: Path) -> Optional[bytes]:
+    """BLAKE2b digest of one file's contents via a single update over an mmap (None if unreadable)."""
+    hasher = hashlib.blake2b()
+    try:
+        with open(path, 'rb') as f:
+            # mmap rejects empty files; their digest is just the empty-input digest
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hasher.update(mm)
+    except Exception as e:
+        print(f"⚠️  Warning: Could not hash {path}: {e}")
+        return None
+    return hasher.digest()
 
 
 class IncrementalTrainingManager:
@@ -20,58 +73,115 @@ class IncrementalTrainingManager:
         self.data_dir = Path(data_dir)
         self.models_dir = Path(models_dir)
         self.metadata_file = self.models_dir / "training_metadata.json"
+        self.versions_file = self.models_dir / "versions.jsonl"
         self.backup_dir = self.models_dir / "backups"
 
         # Ensure directories exist
         self.models_dir.mkdir(exist_ok=True)
         self.backup_dir.mkdir(exist_ok=True)
 
+    def get_file_sigs(self) -> Dict[str, List[int]]:
+        """Map each scenario file's relative path to [mtime_ns, size] (stat only, no reads)."""
+        file_sigs = {}
+        scenarios_dir = self.data_dir / "scenarios"
+        if scenarios_dir.exists():
+            for rel_path, stat in _iter_md_stats(scenarios_dir):
+                file_sigs[rel_path] = [stat.st_mtime_ns, stat.st_size]
+        return file_sigs
+
     def get_data_hash(self) -> str:
         """Calculate hash of all training data files."""
         print("🔍 Calculating training data hash...")
 
-        hasher = hashlib.sha256()
+        hasher = hashlib.blake2b()
 
         # Get all markdown files in scenarios directory
+        scenarios_dir = self.data_dir / "scenarios"
         scenario_files = []
-        if (self.data_dir / "scenarios").exists():
-            for scenario_file in sorted((self.data_dir / "scenarios").rglob("*.md")):
-                scenario_files.append(scenario_file)
-
-        # Hash file contents
-        for file_path in scenario_files:
-            try:
-                with open(file_path, 'rb') as f:
-                    hasher.update(f.read())
-                hasher.update(str(file_path).encode())
-            except Exception as e:
-                print(f"⚠️  Warning: Could not hash {file_path}: {e}")
+        if scenarios_dir.exists():
+            scenario_files = sorted(entry.path for entry in _iter_md(scenarios_dir))
+        prefix_len = len(os.fsencode(scenarios_dir)) + 1
+
+        # Hash files in parallel (hashlib releases the GIL), then combine in path order
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            digests = executor.map(_blake2b_of, scenario_files)
+
+            for file_path, digest in zip(scenario_files, digests):
+                if digest is not None:
+                    # Length-prefixed path relative to scenarios/, independent of where data_dir lives
+                    rel_path = os.fsencode(file_path)[prefix_len:]
+                    hasher.update(digest)
+                    hasher.update(struct.pack("<I", len(rel_path)))
+                    hasher.update(rel_path)
 
         data_hash = hasher.hexdigest()
         print(f"📊 Data hash: {data_hash[:16]}...")
         return data_hash
 
+    def get_legacy_data_hash(self) -> str:
+        """Data hash in the original format (sha256 of contents + full paths), for migrating old metadata."""
+        hasher = hashlib.sha256()
+
+        scenarios_dir = self.data_dir / "scenarios"
+        if scenarios_dir.exists():
+            for file_path in sorted(scenarios_dir.rglob("*.md")):
+                try:
+                    with open(file_path, 'rb') as f:
+                        hasher.update(f.read())
+                    hasher.update(str(file_path).encode())
+                except Exception as e:
+                    print(f"⚠️  Warning: Could not hash {file_path}: {e}")
+
+        return hasher.hexdigest()
+
     def load_metadata(self) -> Dict:
         """Load training metadata."""
         if self.metadata_file.exists():
             try:
-                with open(self.metadata_file, 'r') as f:
-                    return json.load(f)
+                return read_json(self.metadata_file)
             except Exception as e:
                 print(f"⚠️  Warning: Could not load metadata: {e}")
 
         return {
             "last_training_date": None,
             "last_data_hash": None,
-            "model_versions": [],
+            "file_sigs": {},
+            "data_hash_format": DATA_HASH_FORMAT,
             "current_version": None
         }
 
+    def _iter_versions(self, metadata: Dict) -> Iterator[Dict]:
+        """Version history, oldest first: legacy entries not yet in the versions log, then the log."""
+        legacy_versions = metadata.get("model_versions")
+        if legacy_versions:
+            logged = {version_info.get("version") for version_info in iter_jsonl(self.versions_file)}
+            yield from (info for info in legacy_versions if info.get("version") not in logged)
+        yield from iter_jsonl(self.versions_file)
+
+    def migrate_version_history(self):
+        """Move the model_versions list of older metadata files into the versions log."""
+        metadata = self.load_metadata()
+        if metadata.get("model_versions") is None:
+            return
+
+        print("♻️  Migrating model version history to the versions log...")
+
+        # Rewrite the log with the legacy entries merged in, then drop them from the header;
+        # an interrupted migration is simply merged again on the next run
+        tmp_file = self.versions_file.with_name(self.versions_file.name + ".tmp")
+        tmp_file.unlink(missing_ok=True)
+        for version_info in list(self._iter_versions(metadata)):
+            append_jsonl(tmp_file, version_info)
+        if tmp_file.exists():
+            os.replace(tmp_file, self.versions_file)
+
+        del metadata["model_versions"]
+        self.save_metadata(metadata)
+
     def save_metadata(self, metadata: Dict):
         """Save training metadata."""
         try:
-            with open(self.metadata_file, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            write_json(self.metadata_file, metadata)
             print(f"💾 Metadata saved to {self.metadata_file}")
         except Exception as e:
             print(f"❌ Failed to save metadata: {e}")
@@ -80,7 +190,6 @@ class IncrementalTrainingManager:
         """Check if training data has been updated."""
         print("🔍 Checking for training data updates...")
 
-        current_hash = self.get_data_hash()
         metadata = self.load_metadata()
         last_hash = metadata.get("last_data_hash")
 
@@ -88,10 +197,43 @@ class IncrementalTrainingManager:
             print("📝 No previous training detected - full training required")
             return True, "initial_training"
 
+        if metadata.get("data_hash_format") != DATA_HASH_FORMAT:
+            # Metadata from an older hash format: if the data still matches it, upgrade in place
+            # instead of retraining an unchanged dataset
+            print("♻️  Migrating training metadata to the current data hash format...")
+            if self.get_legacy_data_hash() != last_hash:
+                print("🔄 Training data has changed - incremental training required")
+                return True, "incremental_training"
+
+            metadata["file_sigs"] = self.get_file_sigs()
+            metadata["last_data_hash"] = self.get_data_hash()
+            metadata["data_hash_format"] = DATA_HASH_FORMAT
+            self.save_metadata(metadata)
+
+            print("✅ Training data unchanged - no training needed")
+            return False, "no_changes"
+
+        # Unchanged names/sizes/mtimes mean unchanged data; skip reading the files
+        current_sigs = self.get_file_sigs()
+        last_sigs = metadata.get("file_sigs") or {}
+        if current_sigs == last_sigs:
+            print("✅ Training data unchanged - no training needed")
+            return False, "no_changes"
+
+        changed = sum(1 for path, sig in current_sigs.items() if last_sigs.get(path) != sig)
+        removed = len(last_sigs.keys() - current_sigs.keys())
+        print(f"📝 {changed} new or modified, {removed} removed file(s) since last training")
+
+        current_hash = self.get_data_hash()
+
         if current_hash != last_hash:
             print("🔄 Training data has changed - incremental training required")
             return True, "incremental_training"
 
+        # Files were only touched; remember the new stats so the next check stays cheap
+        metadata["file_sigs"] = current_sigs
+        self.save_metadata(metadata)
+
         print("✅ Training data unchanged - no training needed")
         return False, "no_changes"
 
@@ -106,10 +248,7 @@ class IncrementalTrainingManager:
         backup_path = self.backup_dir / f"model_v{version}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
         try:
-            if model_path.is_dir():
-                shutil.copytree(model_path, backup_path)
-            else:
-                shutil.copy2(model_path, backup_path)
+            clone_tree(model_path, backup_path)
 
             print(f"✅ Backup created at {backup_path}")
             return backup_path
@@ -120,17 +259,20 @@ class IncrementalTrainingManager:
 
     def get_next_version(self, metadata: Dict) -> str:
         """Get next version number."""
-        versions = metadata.get("model_versions", [])
-        if not versions:
+        count = 0
+        latest_info = None
+        for latest_info in self._iter_versions(metadata):
+            count += 1
+        if not count:
             return "1.0.0"
 
         # Parse latest version and increment
         try:
-            latest = versions[-1]["version"]
+            latest = latest_info["version"]
             major, minor, patch = map(int, latest.split('.'))
             return f"{major}.{minor}.{patch + 1}"
         except:
-            return f"1.0.{len(versions)}"
+            return f"1.0.{count}"
 
     def perform_incremental_training(self, base_model_path: Path, training_type: str) -> bool:
         """Perform incremental training on existing model."""
@@ -176,15 +318,12 @@ class IncrementalTrainingManager:
             # Remove failed model
             if model_path.exists():
                 if model_path.is_dir():
-                    shutil.rmtree(model_path)
+                    fast_rmtree(model_path)
                 else:
                     model_path.unlink()
 
             # Restore backup
-            if backup_path.is_dir():
-                shutil.copytree(backup_path, model_path)
-            else:
-                shutil.copy2(backup_path, model_path)
+            clone_tree(backup_path, model_path)
 
             print("✅ Rollback completed successfully!")
             return True
@@ -194,7 +333,8 @@ class IncrementalTrainingManager:
             return False
 
     def update_version_info(self, metadata: Dict, version: str, training_type: str, success: bool):
-        """Update version information in metadata."""
+        """Record a version in the versions log and update the metadata header."""
+        file_sigs = self.get_file_sigs()
         version_info = {
             "version": version,
             "date": datetime.now().isoformat(),
@@ -203,17 +343,21 @@ class IncrementalTrainingManager:
             "success": success
         }
 
-        metadata["model_versions"].append(version_info)
+        append_jsonl(self.versions_file, version_info)
         if success:
             metadata["current_version"] = version
             metadata["last_training_date"] = version_info["date"]
             metadata["last_data_hash"] = version_info["data_hash"]
+            metadata["file_sigs"] = file_sigs
+            metadata["data_hash_format"] = DATA_HASH_FORMAT
 
     def run_incremental_training(self) -> bool:
         """Main function to run incremental training workflow."""
         print("🔄 Starting Incremental Training Workflow")
         print("=" * 50)
 
+        self.migrate_version_history()
+
         # Check for updates
         needs_training, training_type = self.check_for_updates()
 
@@ -271,35 +415,42 @@ class IncrementalTrainingManager:
     def list_versions(self):
         """List all model versions."""
         metadata = self.load_metadata()
-        versions = metadata.get("model_versions", [])
 
         print("\n📦 Model Version History")
         print("=" * 40)
 
-        if not versions:
-            print("No versions found")
-            return
-
-        for version_info in versions:
+        found = False
+        for version_info in self._iter_versions(metadata):
+            found = True
             status = "✅" if version_info["success"] else "❌"
             current = "🎯" if version_info["version"] == metadata.get("current_version") else "  "
             print(f"{current} {status} v{version_info['version']} - {version_info['date'][:19]} - {version_info['training_type']}")
 
+        if not found:
+            print("No versions found")
+
     def cleanup_old_backups(self, keep_count: int = 5):
         """Clean up old backup files, keeping only the most recent ones."""
         print(f"🧹 Cleaning up old backups (keeping {keep_count} most recent)...")
 
         try:
-            backups = sorted(self.backup_dir.glob("model_v*"), key=lambda x: x.stat().st_mtime, reverse=True)
-
-            for backup in backups[keep_count:]:
-                if backup.is_dir():
-                    shutil.rmtree(backup)
+            with os.scandir(self.backup_dir) as entries:
+                backups = [entry for entry in entries if entry.name.startswith("model_v")]
+
+            # Only the newest keep_count need ordering; a bounded heap avoids sorting them all
+            keep = {entry.name for entry in heapq.nlargest(
+                keep_count, backups, key=lambda entry: entry.stat(follow_symlinks=False).st_mtime
+            )}
+            stale = [entry for entry in backups if entry.name not in keep]
+
+            for backup in stale:
+                if backup.is_dir(follow_symlinks=False):
+                    fast_rmtree(backup.path)
                 else:
-                    backup.unlink()
+                    os.unlink(backup.path)
                 print(f"🗑️  Removed old backup: {backup.name}")
 
-            print(f"✅ Cleanup completed - {len(backups[keep_count:])} backups removed")
+            print(f"✅ Cleanup completed - {len(stale)} backups removed")
 
         except Exception as e:
             print(f"⚠️  Cleanup warning: {e}")
@@ -5,8 +5,22 @@ Usage: python install_deps.py
 """
 
 import platform
+import shutil
 import subprocess
 import sys
+from typing import List
+
+
+def _installer_command() -> List[str]:
+    """Return the install command prefix, preferring uv over pip."""
+    uv = shutil.which("uv")
+    if uv:
+        return [uv, "pip", "install", "--python", sys.executable]
+
+    return [
+        sys.executable, "-m", "pip", "install",
+        "--disable-pip-version-check", "--no-input", "--prefer-binary"
+    ]
 
 
 def install_dependencies():
@@ -34,17 +48,17 @@ def install_dependencies():
         "protobuf"
     ]
 
+    installer = _installer_command()
+
+    # One install invocation so the resolver runs once over the whole set
     print("Installing basic packages...")
-    for package in basic_packages:
-        print(f"  Installing {package}...")
-        result = subprocess.run([
-            sys.executable, "-m", "pip", "install", package
-        ], capture_output=True, text=True)
-
-        if result.returncode != 0:
-            print(f"❌ Failed to install {package}")
-            print(f"Error: {result.stderr}")
-            return False
+    print(f"  Installing {' '.join(basic_packages)}...")
+    result = subprocess.run(installer + basic_packages, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        print("❌ Failed to install basic packages")
+        print(f"Error: {result.stderr}")
+        return False
 
     # Install Unsloth based on platform
     if platform.machine() == 'arm64':  # Apple Silicon
@@ -57,10 +71,8 @@ def install_dependencies():
 
         unsloth_installed = False
         for approach in unsloth_approaches:
-            print(f"  Trying: pip install {' '.join(approach)}")
-            result = subprocess.run([
-                sys.executable, "-m", "pip", "install"
-            ] + approach, capture_output=True, text=True)
+            print(f"  Trying: install {' '.join(approach)}")
+            result = subprocess.run(installer + approach, capture_output=True, text=True)
 
             if result.returncode == 0:
                 unsloth_installed = True
@@ -79,9 +91,7 @@ def install_dependencies():
 
         for package in unsloth_packages:
             print(f"  Installing {package}...")
-            result = subprocess.run([
-                sys.executable, "-m", "pip", "install", package
-            ], capture_output=True, text=True)
+            result = subprocess.run(installer + [package], capture_output=True, text=True)
 
             if result.returncode != 0:
                 print(f"⚠️  Warning: Failed to install {package}")
@@ -93,11 +103,14 @@ def install_dependencies():
 
 def verify_installation():
     """Verify that key packages are installed correctly."""
+    from importlib.metadata import PackageNotFoundError, version
+
     print("🔍 Verifying installation...")
 
+    # Versions come from the installed dist-info; only torch is imported, for the device check
     try:
+        print(f"✅ PyTorch {version('torch')}")
         import torch
-        print(f"✅ PyTorch {torch.__version__}")
 
         if torch.cuda.is_available():
             print(f"✅ CUDA available: {torch.cuda.get_device_name()}")
@@ -106,28 +119,27 @@ def verify_installation():
         else:
             print("⚠️  CPU only (training will be slower)")
 
-    except ImportError:
+    except (PackageNotFoundError, ImportError):
         print("❌ PyTorch not found")
         return False
 
     try:
-        import transformers
-        print(f"✅ Transformers {transformers.__version__}")
-    except ImportError:
+        print(f"✅ Transformers {version('transformers')}")
+    except PackageNotFoundError:
         print("❌ Transformers not found")
         return False
 
     try:
-        import datasets
+        version('datasets')
         print(f"✅ Datasets available")
-    except ImportError:
+    except PackageNotFoundError:
         print("❌ Datasets not found")
         return False
 
     try:
-        import unsloth
+        version('unsloth')
         print(f"✅ Unsloth available")
-    except ImportError:
+    except PackageNotFoundError:
         print("⚠️  Unsloth not found - training may not work")
         return False
 
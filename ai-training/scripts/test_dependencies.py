@@ -5,15 +5,68 @@ Tests PyTorch with GPU support, transformers library, PEFT, and GGUF conversion
 """
 
 import importlib
+import importlib.metadata
 import json
-import subprocess
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Optional, Set, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # Optional speed-up; the stdlib encoder is used otherwise
+    orjson = None
+
+try:
+    from libversion import version_compare2
+except ImportError:  # Optional C comparator; packaging is used otherwise
+    version_compare2 = None
+
+try:
+    from packaging.version import Version
+except ImportError:  # Minimum versions are not enforced without libversion or packaging
+    Version = None
+
+# Recommended minimum versions, parsed once at import
+MIN_VERSIONS = {"torch": "2.0.0", "transformers": "4.30.0", "peft": "0.4.0", "gguf": "0.1.0"}
+if version_compare2 is None and Version is not None:
+    MIN_VERSIONS = {name: Version(version) for name, version in MIN_VERSIONS.items()}
+
+# Install hint for each package, in the order recommendations are listed
+INSTALL_HINTS = {
+    "torch": "Install PyTorch with: pip install torch",
+    "transformers": "Install Transformers with: pip install transformers",
+    "peft": "Install PEFT with: pip install peft",
+    "gguf": "Install GGUF with: pip install gguf",
+    "llama_cpp": "Install llama-cpp-python with: pip install llama-cpp-python",
+}
+
+def _below_minimum(version: str, min_version: Union[str, "Version"]) -> bool:
+    """Compare an installed version against a minimum with libversion, falling back to packaging"""
+    if version_compare2 is not None:
+        # Drop local labels like +cu118, which libversion would rank as a pre-release
+        return version_compare2(version.split("+")[0], str(min_version)) < 0
+    if Version is not None:
+        if isinstance(min_version, str):
+            min_version = Version(min_version)
+        return Version(version) < min_version
+    return False
+
+
+def _normalize_dist_name(name: str) -> str:
+    """PEP 503 normalized distribution name (e.g. llama_cpp_python -> llama-cpp-python)"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+# Packages whose failure fails the run
+CRITICAL_DEPENDENCIES = {"torch", "transformers", "peft", "gguf"}
 
 
 class DependencyValidator:
-    def __init__(self):
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self._torch = None
         self.results = {
             "dependencies": {},
             "versions": {},
@@ -22,44 +75,75 @@ class DependencyValidator:
             "errors": [],
             "recommendations": []
         }
+        # Critical dependencies whose latest recorded result is a failure, kept up to date as checks
+        # record results so main() needn't rescan them; a later integration check can clear one
+        self._critical_failures: Set[str] = set()
+
+        self._dists: Optional[Dict[str, str]] = None
+
+    def _installed_versions(self) -> Dict[str, str]:
+        """One scan of site-packages dist-info, shared by every check"""
+        if self._dists is None:
+            dists = list(importlib.metadata.distributions())
+
+            def name_and_version(dist) -> Tuple[str, str]:
+                metadata = dist.metadata  # Reads and parses this dist's METADATA file
+                return metadata["Name"], metadata["Version"]
+
+            # Reading the METADATA files is the slow part; it touches no package code, so do it concurrently
+            with ThreadPoolExecutor(max_workers=min(16, len(dists) or 1)) as executor:
+                self._dists = {
+                    _normalize_dist_name(name): version
+                    for name, version in executor.map(name_and_version, dists)
+                    if name
+                }
+        return self._dists
+
+    def _get_torch(self):
+        """Import torch once and reuse the module for every check"""
+        if self._torch is None:
+            import torch
+            self._torch = torch
+        return self._torch
+
+    def _record_dependency(self, name: str, ok: bool):
+        """Record a dependency result, tracking whether a critical dependency currently fails"""
+        self.results["dependencies"][name] = ok
+        if name in CRITICAL_DEPENDENCIES:
+            if ok:
+                self._critical_failures.discard(name)
+            else:
+                self._critical_failures.add(name)
 
-    def check_package(self, package_name: str, min_version: Optional[str] = None) -> bool:
-        """Check if a package is installed and meets minimum version requirements"""
-        try:
-            module = importlib.import_module(package_name)
-            version = getattr(module, "__version__", "unknown")
-            self.results["versions"][package_name] = version
-
-            if min_version and version != "unknown":
-                # Use packaging.version for proper version comparison
-                try:
-                    import packaging.version
-                    if packaging.version.parse(version) < packaging.version.parse(min_version):
-                        self.results["dependencies"][package_name] = False
-                        self.results["warnings"].append(
-                            f"{package_name} version {version} is below recommended minimum {min_version}"
-                        )
-                        return False
-                except ImportError:
-                    # Fall back to simple string comparison if packaging is not available
-                    pass
-
-            self.results["dependencies"][package_name] = True
-            return True
+    @property
+    def critical_failed(self) -> bool:
+        """Whether any critical dependency's final recorded result is a failure"""
+        return bool(self._critical_failures)
 
-        except ImportError:
-            self.results["dependencies"][package_name] = False
+    def check_package(self, package_name: str, min_version: Optional[Union[str, "Version"]] = None) -> bool:
+        """Check if a package is installed and meets minimum version requirements"""
+        # Read the installed dist-info rather than importing, so no package code runs
+        version = self._installed_versions().get(_normalize_dist_name(package_name))
+        if version is None:
+            self._record_dependency(package_name, False)
             self.results["errors"].append(f"{package_name} is not installed")
             return False
-        except Exception as e:
-            self.results["dependencies"][package_name] = False
-            self.results["errors"].append(f"Error checking {package_name}: {str(e)}")
+        self.results["versions"][package_name] = version
+
+        if min_version and version != "unknown" and _below_minimum(version, min_version):
+            self._record_dependency(package_name, False)
+            self.results["warnings"].append(
+                f"{package_name} version {version} is below recommended minimum {min_version}"
+            )
             return False
 
+        self._record_dependency(package_name, True)
+        return True
+
     def check_pytorch_gpu(self) -> bool:
         """Check if PyTorch has GPU support (CUDA or MPS)"""
         try:
-            import torch
+            torch = self._get_torch()
 
             # Check CUDA availability
             cuda_available = torch.cuda.is_available()
@@ -78,9 +162,10 @@ class DependencyValidator:
                 cuda_version = torch.version.cuda
                 self.results["gpu_support"]["cuda_version"] = cuda_version
 
-                # Get device names
-                cuda_devices = [torch.cuda.get_device_name(i) for i in range(cuda_device_count)]
-                self.results["gpu_support"]["cuda_devices"] = cuda_devices
+                # Device names need a property query per device; only fetch them when asked
+                if self.verbose:
+                    cuda_devices = [torch.cuda.get_device_name(i) for i in range(cuda_device_count)]
+                    self.results["gpu_support"]["cuda_devices"] = cuda_devices
 
             if cuda_available or mps_available:
                 return True
@@ -91,30 +176,28 @@ class DependencyValidator:
         except ImportError:
             self.results["errors"].append("PyTorch is not installed")
             return False
-        except Exception as e:
-            self.results["errors"].append(f"Error checking PyTorch GPU support: {str(e)}")
-            return False
 
     def check_transformers_integration(self) -> bool:
         """Check if transformers library works with PyTorch"""
         try:
-            import torch
+            self._get_torch()
             import transformers
 
             # Try to load a tiny model to test integration
             try:
-                from transformers import AutoModel, AutoTokenizer
-
                 # Just check if the classes are available, don't actually download models
-                self.results["dependencies"]["transformers_pytorch"] = True
+                if not (hasattr(transformers, "AutoModel") and hasattr(transformers, "AutoTokenizer")):
+                    raise AttributeError("transformers is missing AutoModel/AutoTokenizer")
+
+                self._record_dependency("transformers_pytorch", True)
                 return True
             except Exception as e:
-                self.results["dependencies"]["transformers_pytorch"] = False
+                self._record_dependency("transformers_pytorch", False)
                 self.results["warnings"].append(f"Transformers-PyTorch integration issue: {str(e)}")
                 return False
 
         except ImportError as e:
-            self.results["dependencies"]["transformers_pytorch"] = False
+            self._record_dependency("transformers_pytorch", False)
             self.results["errors"].append(f"Missing dependency for transformers-pytorch integration: {str(e)}")
             return False
 
@@ -122,72 +205,56 @@ class DependencyValidator:
         """Check if PEFT library is properly installed"""
         try:
             import peft
-            from peft import LoraConfig, get_peft_model
+            if not (hasattr(peft, "LoraConfig") and hasattr(peft, "get_peft_model")):
+                raise AttributeError("peft is missing LoraConfig/get_peft_model")
 
-            self.results["dependencies"]["peft"] = True
+            self._record_dependency("peft", True)
             return True
         except ImportError:
-            self.results["dependencies"]["peft"] = False
+            self._record_dependency("peft", False)
             self.results["errors"].append("PEFT library is not installed")
             return False
-        except Exception as e:
-            self.results["dependencies"]["peft"] = False
-            self.results["errors"].append(f"Error checking PEFT library: {str(e)}")
-            return False
 
     def check_gguf_tools(self) -> bool:
         """Check if GGUF conversion tools are available"""
         try:
-            # Try importing gguf
+            # Try importing gguf (skipped when it isn't installed at all)
+            if "gguf" not in self._installed_versions():
+                raise ImportError("gguf")
             import gguf
-            self.results["dependencies"]["gguf"] = True
+            self._record_dependency("gguf", True)
 
-            # Check for llama-cpp-python
-            try:
-                import llama_cpp
-                self.results["dependencies"]["llama_cpp"] = True
-                self.results["versions"]["llama_cpp"] = llama_cpp.__version__
-            except ImportError:
-                self.results["dependencies"]["llama_cpp"] = False
+            # Check for llama-cpp-python; its version is in the dist-info, so don't load the native library
+            llama_cpp_version = self._installed_versions().get("llama-cpp-python")
+            if llama_cpp_version is not None:
+                self._record_dependency("llama_cpp", True)
+                self.results["versions"]["llama_cpp"] = llama_cpp_version
+            else:
+                self._record_dependency("llama_cpp", False)
                 self.results["warnings"].append("llama-cpp-python is not installed")
 
             return True
         except ImportError:
-            self.results["dependencies"]["gguf"] = False
+            self._record_dependency("gguf", False)
             self.results["errors"].append("GGUF library is not installed")
             return False
-        except Exception as e:
-            self.results["dependencies"]["gguf"] = False
-            self.results["errors"].append(f"Error checking GGUF tools: {str(e)}")
-            return False
 
     def generate_recommendations(self):
         """Generate dependency-specific recommendations"""
         recommendations = []
 
+        # Collect the missing packages in one pass; absent entries count as missing
+        dependencies = self.results["dependencies"]
+        missing = {name for name in INSTALL_HINTS if not dependencies.get(name, False)}
+
         # PyTorch recommendations
-        if not self.results["dependencies"].get("torch", False):
-            recommendations.append("Install PyTorch with: pip install torch")
-        elif not any([
-            self.results["gpu_support"].get("cuda", False),
-            self.results["gpu_support"].get("mps", False)
-        ]):
+        if "torch" in missing:
+            recommendations.append(INSTALL_HINTS["torch"])
+        elif not (self.results["gpu_support"].get("cuda", False) or self.results["gpu_support"].get("mps", False)):
             recommendations.append("Install PyTorch with GPU support: https://pytorch.org/get-started/locally/")
 
-        # Transformers recommendations
-        if not self.results["dependencies"].get("transformers", False):
-            recommendations.append("Install Transformers with: pip install transformers")
-
-        # PEFT recommendations
-        if not self.results["dependencies"].get("peft", False):
-            recommendations.append("Install PEFT with: pip install peft")
-
-        # GGUF recommendations
-        if not self.results["dependencies"].get("gguf", False):
-            recommendations.append("Install GGUF with: pip install gguf")
-
-        if not self.results["dependencies"].get("llama_cpp", False):
-            recommendations.append("Install llama-cpp-python with: pip install llama-cpp-python")
+        # Transformers, PEFT, GGUF and llama-cpp-python recommendations
+        recommendations.extend(hint for name, hint in INSTALL_HINTS.items() if name != "torch" and name in missing)
 
         self.results["recommendations"] = recommendations
 
@@ -196,29 +263,26 @@ class DependencyValidator:
         print("🔍 Running dependency validation for GGUF model training...")
         print("=" * 60)
 
-        # Check core packages
-        checks = [
-            ("PyTorch", lambda: self.check_package("torch", "2.0.0")),
-            ("PyTorch GPU Support", self.check_pytorch_gpu),
-            ("Transformers", lambda: self.check_package("transformers", "4.30.0")),
-            ("Transformers-PyTorch Integration", self.check_transformers_integration),
-            ("PEFT", lambda: self.check_package("peft", "0.4.0")),
-            ("PEFT Integration", self.check_peft_integration),
-            ("GGUF", lambda: self.check_package("gguf", "0.1.0")),
-            ("GGUF Tools", self.check_gguf_tools),
-        ]
+        # Packages may have just been installed (e.g. from a post-install hook); drop stale
+        # finder caches once here, then take a fresh dist-info snapshot for all checks
+        importlib.invalidate_caches()
+        self._dists = None
+        self._installed_versions()
 
         passed = 0
-        total = len(checks)
+        total = len(CHECKS)
 
-        for name, check_func in checks:
+        for name, check, args, dependency in CHECKS:
             try:
-                result = check_func()
+                result = check(self, *args)
                 status = "✅ PASS" if result else "❌ FAIL"
                 print(f"{name:<30} {status}")
                 if result:
                     passed += 1
             except Exception as e:
+                # Unexpected failures of any check are reported here rather than in each check_*
+                if dependency:
+                    self._record_dependency(dependency, False)
                 print(f"{name:<30} ❌ ERROR: {str(e)}")
                 self.results["errors"].append(f"{name} check failed: {str(e)}")
 
@@ -278,13 +342,41 @@ class DependencyValidator:
 
     def save_results(self, output_path: str = "dependency_validation_results.json"):
         """Save validation results to JSON file"""
-        with open(output_path, 'w') as f:
-            json.dump(self.results, f, indent=2)
+        if orjson:
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(self.results, option=orjson.OPT_INDENT_2))
+        else:
+            with open(output_path, 'w') as f:
+                json.dump(self.results, f, indent=2)
         print(f"\n💾 Results saved to: {output_path}")
 
+# Checks run by run_validation, in order: (label, check, arguments, dependency it records).
+# They run serially on the main thread: the integration checks import torch/transformers/peft,
+# which isn't safe to do from several threads at once, and a package's integration check
+# must record its result after the plain version check
+CHECKS = [
+    ("PyTorch", DependencyValidator.check_package, ("torch", MIN_VERSIONS["torch"]), "torch"),
+    ("PyTorch GPU Support", DependencyValidator.check_pytorch_gpu, (), None),
+    ("Transformers", DependencyValidator.check_package,
+     ("transformers", MIN_VERSIONS["transformers"]), "transformers"),
+    ("Transformers-PyTorch Integration", DependencyValidator.check_transformers_integration, (),
+     "transformers_pytorch"),
+    ("PEFT", DependencyValidator.check_package, ("peft", MIN_VERSIONS["peft"]), "peft"),
+    ("PEFT Integration", DependencyValidator.check_peft_integration, (), "peft"),
+    ("GGUF", DependencyValidator.check_package, ("gguf", MIN_VERSIONS["gguf"]), "gguf"),
+    ("GGUF Tools", DependencyValidator.check_gguf_tools, (), "gguf"),
+]
+
+
 def main():
     """Main validation function"""
-    validator = DependencyValidator()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Validate GGUF model training dependencies")
+    parser.add_argument("--verbose", action="store_true", help="Also list CUDA device names")
+    args = parser.parse_args()
+
+    validator = DependencyValidator(verbose=args.verbose)
     results = validator.run_validation()
 
     # Save results
@@ -293,13 +385,7 @@ def main():
     validator.save_results(str(output_dir / "dependency_validation_results.json"))
 
     # Exit with appropriate code
-    has_errors = len(results["errors"]) > 0
-    critical_failures = any(
-        not results["dependencies"].get(dep, False)
-        for dep in ["torch", "transformers", "peft", "gguf"]
-    )
-
-    if has_errors or critical_failures:
+    if results["errors"] or validator.critical_failed:
         print("\n❌ Dependency validation failed. Please address the errors above before proceeding.")
         sys.exit(1)
     else:
@@ -4,15 +4,83 @@ System validation script for GGUF model training environment.
 Checks hardware requirements, Python version, GPU availability, and system resources.
 """
 
+import functools
 import json
+import os
 import platform
 import shutil
-import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
-import psutil
+try:
+    import orjson
+except ImportError:  # Optional speed-up; the stdlib encoder is used otherwise
+    orjson = None
+
+# GPU probe results are cached here, keyed on host, kernel and driver state
+GPU_CACHE_FILE = Path.home() / ".cache" / "ai-dnd-expo" / "gpu_probe.json"
+
+
+def _gpu_cache_key() -> str:
+    """Key that changes when the host, kernel or NVIDIA driver changes"""
+    driver_version = Path("/proc/driver/nvidia/version")
+    driver_mtime = driver_version.stat().st_mtime_ns if driver_version.exists() else 0
+    return "|".join([
+        platform.node(), platform.machine(), platform.release(),
+        str(shutil.which("nvidia-smi")), str(driver_mtime)
+    ])
+
+
+@functools.lru_cache(maxsize=1)
+def _processor_name() -> str:
+    """CPU model string without platform.processor(), which forks `uname -p` on Linux"""
+    system = platform.system()
+    if system == "Linux":
+        try:
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("model name"):
+                        return line.split(":", 1)[1].strip()
+        except OSError:
+            pass
+        return platform.machine()  # e.g. ARM boards without a model name line
+    if system == "Darwin":
+        import subprocess
+        try:
+            result = subprocess.run(
+                ["sysctl", "-n", "machdep.cpu.brand_string"],
+                capture_output=True, text=True, timeout=5
+            )
+            if result.returncode == 0:
+                return result.stdout.strip()
+        except (subprocess.TimeoutExpired, FileNotFoundError):
+            pass
+    return platform.processor()
+
+
+@functools.lru_cache(maxsize=1)
+def _total_memory_bytes() -> int:
+    """Physical RAM from /proc/meminfo or sysctl, importing psutil only where neither exists"""
+    system = platform.system()
+    if system == "Linux":
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024  # reported in kB
+    elif system == "Darwin":
+        import subprocess
+        result = subprocess.run(["sysctl", "-n", "hw.memsize"], capture_output=True, text=True, timeout=5)
+        if result.returncode == 0:
+            return int(result.stdout)
+
+    import psutil
+    return psutil.virtual_memory().total
+
+
+# Requirements whose failure fails the run
+CRITICAL_REQUIREMENTS = {"python_compatible", "platform_supported", "disk_space_sufficient"}
 
 
 class SystemValidator:
@@ -24,6 +92,14 @@ class SystemValidator:
             "warnings": [],
             "errors": []
         }
+        # Set as soon as any critical requirement fails, so main() needn't rescan the results
+        self.critical_failed = False
+
+    def _record_requirement(self, name: str, ok: bool):
+        """Record a requirement result, flagging the run if a critical requirement fails"""
+        self.results["requirements"][name] = ok
+        if not ok and name in CRITICAL_REQUIREMENTS:
+            self.critical_failed = True
 
     def check_python_version(self) -> bool:
         """Check if Python version is compatible (3.9-3.11)"""
@@ -31,10 +107,10 @@ class SystemValidator:
         self.results["system_info"]["python_version"] = f"{version.major}.{version.minor}.{version.micro}"
 
         if version.major == 3 and 9 <= version.minor <= 11:
-            self.results["requirements"]["python_compatible"] = True
+            self._record_requirement("python_compatible", True)
             return True
         else:
-            self.results["requirements"]["python_compatible"] = False
+            self._record_requirement("python_compatible", False)
             self.results["errors"].append(
                 f"Python {version.major}.{version.minor} not supported. Requires Python 3.9-3.11"
             )
@@ -42,20 +118,20 @@ class SystemValidator:
 
     def check_system_memory(self) -> bool:
         """Check system RAM (≥32GB recommended)"""
-        memory_gb = psutil.virtual_memory().total / (1024**3)
+        memory_gb = _total_memory_bytes() / (1024**3)
         self.results["system_info"]["ram_gb"] = round(memory_gb, 2)
 
         if memory_gb >= 32:
-            self.results["requirements"]["memory_sufficient"] = True
+            self._record_requirement("memory_sufficient", True)
             return True
         elif memory_gb >= 16:
-            self.results["requirements"]["memory_sufficient"] = True
+            self._record_requirement("memory_sufficient", True)
             self.results["warnings"].append(
                 f"System has {memory_gb:.1f}GB RAM. 32GB+ recommended for optimal training performance"
             )
             return True
         else:
-            self.results["requirements"]["memory_sufficient"] = False
+            self._record_requirement("memory_sufficient", False)
             self.results["errors"].append(
                 f"Insufficient RAM: {memory_gb:.1f}GB. Minimum 16GB required, 32GB+ recommended"
             )
@@ -63,15 +139,19 @@ class SystemValidator:
 
     def check_disk_space(self) -> bool:
         """Check available disk space (≥50GB required)"""
-        disk_usage = shutil.disk_usage(".")
-        free_gb = disk_usage.free / (1024**3)
+        if hasattr(os, "statvfs"):
+            stats = os.statvfs(".")
+            free_bytes = stats.f_bavail * stats.f_frsize
+        else:  # Windows
+            free_bytes = shutil.disk_usage(".").free
+        free_gb = free_bytes / (1024**3)
         self.results["system_info"]["disk_free_gb"] = round(free_gb, 2)
 
         if free_gb >= 50:
-            self.results["requirements"]["disk_space_sufficient"] = True
+            self._record_requirement("disk_space_sufficient", True)
             return True
         else:
-            self.results["requirements"]["disk_space_sufficient"] = False
+            self._record_requirement("disk_space_sufficient", False)
             self.results["errors"].append(
                 f"Insufficient disk space: {free_gb:.1f}GB free. Minimum 50GB required"
             )
@@ -79,56 +159,77 @@ class SystemValidator:
 
     def check_gpu_availability(self) -> Tuple[bool, Optional[str]]:
         """Check GPU availability and type (CUDA/MPS)"""
-        gpu_info = {"available": False, "type": None, "memory_gb": 0}
-
-        # Check for NVIDIA GPU (CUDA)
+        cache_key = _gpu_cache_key()
         try:
-            result = subprocess.run(
-                ["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
-                capture_output=True, text=True, timeout=10
-            )
-            if result.returncode == 0:
-                memory_mb = int(result.stdout.strip())
-                memory_gb = memory_mb / 1024
-                gpu_info.update({
-                    "available": True,
-                    "type": "CUDA",
-                    "memory_gb": round(memory_gb, 2)
-                })
-        except (subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError, ValueError):
-            pass
+            with open(GPU_CACHE_FILE, 'r') as f:
+                cached = json.load(f)
+            gpu_info = cached["gpu_info"] if cached.get("key") == cache_key else None
+        except (OSError, ValueError, KeyError):
+            gpu_info = None
+
+        if gpu_info is None:
+            gpu_info = self._probe_gpu()
+            try:
+                GPU_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+                with open(GPU_CACHE_FILE, 'w') as f:
+                    json.dump({"key": cache_key, "gpu_info": gpu_info}, f, indent=2)
+            except OSError:
+                pass  # Caching is best-effort
 
-        # Check for Apple Silicon (MPS) on macOS
-        if platform.system() == "Darwin":
+        self.results["system_info"]["gpu"] = gpu_info
+        return self._report_gpu(gpu_info)
+
+    def _probe_gpu(self) -> Dict:
+        """Probe for an NVIDIA (CUDA) or Apple Silicon (MPS) GPU"""
+        gpu_info = {"available": False, "type": None, "memory_gb": 0}
+
+        # Check for NVIDIA GPU (CUDA); skip the spawn (and the subprocess import) without the driver tools
+        if shutil.which("nvidia-smi") is not None:
+            import subprocess
             try:
                 result = subprocess.run(
-                    ["system_profiler", "SPDisplaysDataType"],
-                    capture_output=True, text=True, timeout=10
+                    ["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
+                    capture_output=True, text=True, timeout=5
                 )
-                if "Apple" in result.stdout and ("M1" in result.stdout or "M2" in result.stdout or "M3" in result.stdout):
-                    # Apple Silicon GPUs don't have discrete memory, use system RAM
+                if result.returncode == 0:
+                    # One line per GPU; report the largest
+                    memory_mb = max(int(line) for line in result.stdout.split())
+                    memory_gb = memory_mb / 1024
                     gpu_info.update({
                         "available": True,
-                        "type": "MPS",
-                        "memory_gb": self.results["system_info"]["ram_gb"]  # Unified memory
+                        "type": "CUDA",
+                        "memory_gb": round(memory_gb, 2)
                     })
-            except (subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError):
+            except (subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError, ValueError):
                 pass
 
-        self.results["system_info"]["gpu"] = gpu_info
-
+        # Check for Apple Silicon (MPS) on macOS; every arm64 Mac has an MPS-capable GPU
+        if platform.system() == "Darwin" and platform.machine() == "arm64":
+            # Apple Silicon GPUs don't have discrete memory, use system RAM
+            gpu_info.update({
+                "available": True,
+                "type": "MPS",
+                "chip": _processor_name(),
+                # Unified memory; read directly since the memory check may still be running
+                "memory_gb": round(_total_memory_bytes() / (1024**3), 2)
+            })
+
+        return gpu_info
+
+    def _report_gpu(self, gpu_info: Dict) -> Tuple[bool, Optional[str]]:
+        """Record GPU requirements and warnings for a probe result"""
         if gpu_info["available"]:
             if gpu_info["memory_gb"] >= 16:
-                self.results["requirements"]["gpu_memory_sufficient"] = True
+                self._record_requirement("gpu_memory_sufficient", True)
                 return True, gpu_info["type"]
             else:
-                self.results["requirements"]["gpu_memory_sufficient"] = False
+                self._record_requirement("gpu_memory_sufficient", False)
                 self.results["warnings"].append(
                     f"GPU has {gpu_info['memory_gb']:.1f}GB memory. 16GB+ recommended for training"
                 )
                 return True, gpu_info["type"]
         else:
-            self.results["requirements"]["gpu_memory_sufficient"] = False
+            self._record_requirement("gpu_memory_sufficient", False)
             self.results["warnings"].append(
                 "No GPU detected. Training will use CPU (significantly slower)"
             )
@@ -139,16 +240,16 @@ class SystemValidator:
         system_info = {
             "platform": platform.system(),
             "architecture": platform.machine(),
-            "processor": platform.processor()
+            "processor": _processor_name()
         }
         self.results["system_info"]["platform"] = system_info
 
         # All major platforms supported
         if system_info["platform"] in ["Darwin", "Linux", "Windows"]:
-            self.results["requirements"]["platform_supported"] = True
+            self._record_requirement("platform_supported", True)
             return True
         else:
-            self.results["requirements"]["platform_supported"] = False
+            self._record_requirement("platform_supported", False)
             self.results["errors"].append(f"Unsupported platform: {system_info['platform']}")
             return False
 
@@ -196,16 +297,20 @@ class SystemValidator:
         passed = 0
         total = len(checks)
 
-        for name, check_func in checks:
-            try:
-                result = check_func()
-                status = "✅ PASS" if result else "❌ FAIL"
-                print(f"{name:<20} {status}")
-                if result:
-                    passed += 1
-            except Exception as e:
-                print(f"{name:<20} ❌ ERROR: {str(e)}")
-                self.results["errors"].append(f"{name} check failed: {str(e)}")
+        # The checks are independent; run them concurrently and report in the order listed
+        with ThreadPoolExecutor(max_workers=total) as executor:
+            futures = [(name, executor.submit(check_func)) for name, check_func in checks]
+
+            for name, future in futures:
+                try:
+                    result = future.result()
+                    status = "✅ PASS" if result else "❌ FAIL"
+                    print(f"{name:<20} {status}")
+                    if result:
+                        passed += 1
+                except Exception as e:
+                    print(f"{name:<20} ❌ ERROR: {str(e)}")
+                    self.results["errors"].append(f"{name} check failed: {str(e)}")
 
         print("=" * 60)
         print(f"Validation Summary: {passed}/{total} checks passed")
@@ -255,8 +360,12 @@ class SystemValidator:
 
     def save_results(self, output_path: str = "system_validation_results.json"):
         """Save validation results to JSON file"""
-        with open(output_path, 'w') as f:
-            json.dump(self.results, f, indent=2)
+        if orjson:
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(self.results, option=orjson.OPT_INDENT_2))
+        else:
+            with open(output_path, 'w') as f:
+                json.dump(self.results, f, indent=2)
         print(f"\n💾 Results saved to: {output_path}")
 
 def main():
@@ -270,13 +379,7 @@ def main():
     validator.save_results(str(output_dir / "system_validation_results.json"))
 
     # Exit with appropriate code
-    has_errors = len(results["errors"]) > 0
-    critical_failures = any(
-        not results["requirements"].get(req, False)
-        for req in ["python_compatible", "platform_supported", "disk_space_sufficient"]
-    )
-
-    if has_errors or critical_failures:
+    if results["errors"] or validator.critical_failed:
         print("\n❌ System validation failed. Please address the errors above before proceeding.")
         sys.exit(1)
     else:
@@ -4,18 +4,127 @@ Simple GGUF Conversion Script
 A simpler approach using Python libraries for GGUF conversion
 """
 
+import gc
 import json
 import os
 import shutil
+import struct
+import subprocess
 import sys
-import tempfile
+from functools import cached_property
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 import torch
 from peft import PeftModel
+from safetensors import safe_open
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
+from _script_utils import read_json, set_cpu_threads, write_json
+from convert_to_gguf import GGUFConverter
+
+_SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+# Matches save_pretrained(max_shard_size="500MB"); small shards let llama.cpp stream the conversion
+MAX_SHARD_BYTES = 500 * 1000 ** 2
+
+
+def _save_safetensors_streaming(state_dict: Dict[str, "torch.Tensor"], names: List[str], path: Path):
+    """Write the named tensors to a safetensors file one at a time, so peak overhead is the largest tensor."""
+    # Pass 1: lay out the header from shapes and dtypes only
+    header = {"__metadata__": {"format": "pt"}}
+    offset = 0
+    for name in names:
+        tensor = state_dict[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": _SAFETENSORS_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    # Pass 2: stream each tensor's bytes straight from its buffer
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            tensor = state_dict[name].detach().to("cpu").contiguous()
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+
+
+def _save_sharded_safetensors(state_dict: Dict[str, "torch.Tensor"], out_dir: Path,
+                              max_shard_bytes: int = MAX_SHARD_BYTES):
+    """Stream a state dict into safetensors shards plus an index, laid out like save_pretrained."""
+    shards: List[List[str]] = [[]]
+    shard_bytes = 0
+    total_bytes = 0
+    seen = set()
+    for name, tensor in state_dict.items():
+        # Tied weights (e.g. lm_head/wte) share storage; keep the first, as save_pretrained does
+        key = (tensor.data_ptr(), tuple(tensor.shape), tensor.dtype)
+        if tensor.numel() and key in seen:
+            continue
+        seen.add(key)
+
+        nbytes = tensor.numel() * tensor.element_size()
+        if shards[-1] and shard_bytes + nbytes > max_shard_bytes:
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append(name)
+        shard_bytes += nbytes
+        total_bytes += nbytes
+
+    if len(shards) == 1:
+        _save_safetensors_streaming(state_dict, shards[0], out_dir / "model.safetensors")
+        return
+
+    weight_map = {}
+    for i, names in enumerate(shards, 1):
+        shard_name = f"model-{i:05d}-of-{len(shards):05d}.safetensors"
+        _save_safetensors_streaming(state_dict, names, out_dir / shard_name)
+        weight_map.update(dict.fromkeys(names, shard_name))
+
+    index = {"metadata": {"total_size": total_bytes}, "weight_map": weight_map}
+    write_json(out_dir / "model.safetensors.index.json", index)
+
+
+def _dir_size(path: Path, suffixes=(".safetensors", ".bin")) -> int:
+    """Total size of the weight files directly under path, from a single scandir pass."""
+    with os.scandir(path) as it:
+        return sum(e.stat().st_size for e in it if e.name.endswith(suffixes) and e.is_file())
+
+
+def _tensor_info(model_dir: Path) -> List[Dict[str, Any]]:
+    """Name, dtype and shape of every tensor in the safetensors shards, read from the headers only."""
+    tensors = []
+    for shard in sorted(model_dir.glob("*.safetensors")):
+        with safe_open(shard, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                tensor_slice = f.get_slice(name)
+                tensors.append({
+                    "name": name,
+                    "dtype": tensor_slice.get_dtype(),
+                    "shape": tensor_slice.get_shape(),
+                    "file": shard.name
+                })
+    return tensors
+
 
 class SimpleGGUFConverter:
     """Simple GGUF converter using Python libraries."""
@@ -28,16 +137,21 @@ class SimpleGGUFConverter:
         else:
             self.model_path = Path(model_path)
         self.output_dir = Path(output_dir) if output_dir else self.model_path.parent / "gguf"
-        self.temp_dir = None
+        self.merged_model = None
+        self.tokenizer = None
 
     def merge_lora_adapter(self) -> Path:
         """Merge LoRA adapter with base model."""
         print("🔗 Merging LoRA adapter with base model...")
 
+        # Save straight into the output directory; the staging name is swapped in once complete
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        model_dir = self.output_dir / "model"
+        staging_dir = self.output_dir / "model.tmp"
+
         try:
-            # Create temporary directory for merged model
-            self.temp_dir = Path(tempfile.mkdtemp(prefix="merged_model_"))
-            print(f"📁 Using temporary directory: {self.temp_dir}")
+            if staging_dir.exists():
+                shutil.rmtree(staging_dir)
 
             # Load base model
             base_model_name = "microsoft/DialoGPT-medium"
@@ -45,7 +159,8 @@ class SimpleGGUFConverter:
 
             base_model = AutoModelForCausalLM.from_pretrained(
                 base_model_name,
-                torch_dtype=torch.float32,  # Use float32 for compatibility
+                torch_dtype="auto",  # Keep the checkpoint's native dtype
+                low_cpu_mem_usage=True,
                 device_map="cpu",
             )
 
@@ -56,49 +171,56 @@ class SimpleGGUFConverter:
             model = PeftModel.from_pretrained(base_model, self.model_path)
 
             print("🔀 Merging adapter with base model...")
-            merged_model = model.merge_and_unload()
+            # bf16 halves the bytes written and keeps the range llama.cpp converts from
+            merged_model = model.merge_and_unload().to(torch.bfloat16)
+
+            # Drop the PEFT wrapper and base references before saving
+            del model, base_model
+            gc.collect()
 
             # Save merged model
-            print(f"💾 Saving merged model to: {self.temp_dir}")
-            merged_model.save_pretrained(self.temp_dir, safe_serialization=True)
-            tokenizer.save_pretrained(self.temp_dir)
+            print(f"💾 Saving merged model to: {model_dir}")
+            staging_dir.mkdir()
+            _save_sharded_safetensors(merged_model.state_dict(), staging_dir)
+            merged_model.config.torch_dtype = torch.bfloat16  # save_pretrained would record this itself
+            merged_model.config.save_pretrained(staging_dir)
+            if merged_model.can_generate():
+                merged_model.generation_config.save_pretrained(staging_dir)
+            tokenizer.save_pretrained(staging_dir)
+
+            if model_dir.exists():
+                shutil.rmtree(model_dir)
+            os.replace(staging_dir, model_dir)
+
+            # Keep the merged model around so the test doesn't reload it from disk
+            self.merged_model = merged_model
+            self.tokenizer = tokenizer
 
             print("✅ Model merged successfully!")
-            return self.temp_dir
+            return model_dir
 
         except Exception as e:
             print(f"❌ Failed to merge model: {e}")
-            if self.temp_dir and self.temp_dir.exists():
-                shutil.rmtree(self.temp_dir)
+            if staging_dir.exists():
+                shutil.rmtree(staging_dir)
             raise
 
-    def create_gguf_placeholder(self, merged_model_path: Path) -> Path:
+    def create_gguf_placeholder(self, model_dir: Path) -> Path:
         """Create a GGUF placeholder file with model info."""
         print("📦 Creating GGUF model package...")
 
-        # Create output directory
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-
-        # Copy merged model to output directory
-        model_dir = self.output_dir / "model"
-        if model_dir.exists():
-            shutil.rmtree(model_dir)
-
-        shutil.copytree(merged_model_path, model_dir)
-
         # Create a "GGUF-ready" marker file with instructions
         gguf_info_file = self.output_dir / "gguf_conversion_info.json"
 
         # Get model size
-        model_files = list(model_dir.glob("*.safetensors")) + list(model_dir.glob("*.bin"))
-        total_size = sum(f.stat().st_size for f in model_files)
-        size_mb = total_size / (1024 * 1024)
+        size_mb = _dir_size(model_dir) / (1024 * 1024)
 
         gguf_info = {
             "status": "ready_for_conversion",
             "merged_model_path": str(model_dir),
             "original_model": str(self.model_path),
             "size_mb": round(size_mb, 2),
+            "tensors": _tensor_info(model_dir),
             "conversion_instructions": [
                 "This model has been merged and is ready for GGUF conversion",
                 "To convert to actual GGUF format, you'll need llama.cpp",
@@ -113,31 +235,61 @@ class SimpleGGUFConverter:
             }
         }
 
-        with open(gguf_info_file, 'w') as f:
-            json.dump(gguf_info, f, indent=2)
+        write_json(gguf_info_file, gguf_info)
 
         print(f"✅ Model package created at: {self.output_dir}")
         return gguf_info_file
 
-    def generate_cactus_config(self) -> Dict[str, Any]:
+    def convert_with_llama_cpp(self, model_dir: Path, quantization: str = "Q4_K_M") -> Optional[Path]:
+        """Convert the merged model to a quantized GGUF with convert_to_gguf's llama.cpp pipeline, when it is installed."""
+        converter = GGUFConverter(str(self.model_path), str(self.output_dir))
+        if not converter.check_llama_cpp():
+            print("⚠️  Keeping the HuggingFace model only")
+            return None
+
+        try:
+            gguf_file, _ = converter._convert_and_quantize(model_dir, quantization)
+            print(f"✅ GGUF model created: {gguf_file}")
+            return gguf_file
+
+        except (subprocess.CalledProcessError, OSError):
+            # convert_to_gguf has already reported the failure and the tool's output
+            return None
+
+    @cached_property
+    def base_config(self) -> Dict[str, Any]:
+        """The trained model's original cactus config, parsed once ({} if missing)."""
+        try:
+            return read_json(self.model_path / "cactus_config.json")
+        except FileNotFoundError:
+            return {}
+
+    def generate_cactus_config(self, gguf_file: Optional[Path] = None) -> Dict[str, Any]:
         """Generate CactusTTS configuration."""
         print("⚙️  Generating CactusTTS configuration...")
 
-        # Load original cactus config if available
-        original_config_path = self.model_path / "cactus_config.json"
-        if original_config_path.exists():
-            with open(original_config_path, 'r') as f:
-                base_config = json.load(f)
+        base_config = self.base_config
+
+        if gguf_file:
+            model_info = {"type": "gguf", "path": f"./ai-training/trained_models/gguf/{gguf_file.name}", "format": "gguf"}
+            conversion_info = {
+                "status": "gguf_ready",
+                "note": "Quantized GGUF produced by llama.cpp",
+                "source_model": "./ai-training/trained_models/gguf/model"
+            }
         else:
-            base_config = {}
+            model_info = {"type": "huggingface", "path": "./ai-training/trained_models/gguf/model", "format": "safetensors"}
+            conversion_info = {
+                "status": "merged_model_ready",
+                "note": "This is a merged HuggingFace model, not yet GGUF format",
+                "next_steps": "Convert to GGUF using llama.cpp for CactusTTS compatibility"
+            }
 
         # Create configuration for the merged model
         config = {
             "model": {
                 "name": f"{base_config.get('model', {}).get('name', 'dnd_model')}_merged",
-                "type": "huggingface",  # For now, until GGUF conversion
-                "path": f"./ai-training/trained_models/gguf/model",
-                "format": "safetensors",
+                **model_info,
                 "context_length": base_config.get('model', {}).get('context_length', 2048)
             },
             "system_prompt": base_config.get('system_prompt',
@@ -154,17 +306,12 @@ class SimpleGGUFConverter:
                 "format": "[{tool_name}: {arguments}]",
                 "supported": ["roll", "health", "inventory", "spellcast", "check", "save"]
             }),
-            "conversion_info": {
-                "status": "merged_model_ready",
-                "note": "This is a merged HuggingFace model, not yet GGUF format",
-                "next_steps": "Convert to GGUF using llama.cpp for CactusTTS compatibility"
-            }
+            "conversion_info": conversion_info
         }
 
         # Save config
         config_file = self.output_dir / "cactus_config.json"
-        with open(config_file, 'w') as f:
-            json.dump(config, f, indent=2)
+        write_json(config_file, config)
 
         print(f"✅ Configuration saved to: {config_file}")
         return config
@@ -172,27 +319,33 @@ class SimpleGGUFConverter:
     def test_merged_model(self) -> Dict[str, Any]:
         """Test the merged model to ensure it works."""
         print("🧪 Testing merged model...")
+        set_cpu_threads()
 
         try:
-            model_dir = self.output_dir / "model"
-
-            # Load the merged model
-            model = AutoModelForCausalLM.from_pretrained(
-                model_dir,
-                torch_dtype=torch.float32,
-                device_map="cpu"
-            )
-            tokenizer = AutoTokenizer.from_pretrained(model_dir)
+            model = self.merged_model
+            tokenizer = self.tokenizer
+
+            # Fall back to loading the saved model if the merge didn't run in this process
+            if model is None:
+                model_dir = self.output_dir / "model"
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_dir,
+                    torch_dtype="auto",
+                    low_cpu_mem_usage=True,
+                    device_map="cpu"
+                )
+                tokenizer = AutoTokenizer.from_pretrained(model_dir)
+            model.eval()
 
             # Test generation
             test_prompt = "User: I want to roll for perception.\nDM:"
             inputs = tokenizer.encode(test_prompt, return_tensors="pt")
 
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = model.generate(
                     inputs,
-                    max_length=inputs.shape[1] + 50,
-                    num_return_sequences=1,
+                    max_new_tokens=50,
+                    use_cache=True,
                     temperature=0.7,
                     do_sample=True,
                     pad_token_id=tokenizer.eos_token_id,
@@ -213,11 +366,10 @@ class SimpleGGUFConverter:
                 "error": str(e)
             }
 
-    def cleanup(self):
-        """Clean up temporary files."""
-        if self.temp_dir and self.temp_dir.exists():
-            print(f"🧹 Cleaning up temporary files: {self.temp_dir}")
-            shutil.rmtree(self.temp_dir)
+        finally:
+            # Release the merged weights before returning
+            self.merged_model = None
+            gc.collect()
 
     def convert(self) -> Dict[str, Any]:
         """Run the conversion process."""
@@ -226,21 +378,25 @@ class SimpleGGUFConverter:
 
         try:
             # Merge LoRA adapter
-            merged_model_path = self.merge_lora_adapter()
+            model_dir = self.merge_lora_adapter()
 
             # Create GGUF-ready package
-            info_file = self.create_gguf_placeholder(merged_model_path)
-
-            # Generate Cactus config
-            cactus_config = self.generate_cactus_config()
+            info_file = self.create_gguf_placeholder(model_dir)
 
-            # Test the merged model
+            # Test the merged model (this also frees it before llama.cpp runs)
             test_result = self.test_merged_model()
 
+            # Produce a quantized GGUF when llama.cpp is available
+            gguf_file = self.convert_with_llama_cpp(model_dir)
+
+            # Generate Cactus config
+            cactus_config = self.generate_cactus_config(gguf_file)
+
             result = {
                 "success": True,
                 "output_dir": str(self.output_dir),
                 "model_dir": str(self.output_dir / "model"),
+                "gguf_file": str(gguf_file) if gguf_file else None,
                 "info_file": str(info_file),
                 "cactus_config": cactus_config,
                 "test_result": test_result
@@ -250,6 +406,8 @@ class SimpleGGUFConverter:
             print("🎉 MODEL CONVERSION COMPLETED!")
             print("=" * 60)
             print(f"📁 Model Directory: {self.output_dir / 'model'}")
+            if gguf_file:
+                print(f"📦 GGUF Model: {gguf_file}")
             print(f"⚙️  Config File: {self.output_dir / 'cactus_config.json'}")
             print(f"📋 Info File: {info_file}")
 
@@ -261,7 +419,10 @@ class SimpleGGUFConverter:
 
             print("\n💡 Next Steps:")
             print("1. The model has been merged and is ready for use")
-            print("2. For GGUF conversion, install llama.cpp and follow instructions in gguf_conversion_info.json")
+            if gguf_file:
+                print(f"2. Deploy {gguf_file.name} to CactusTTS")
+            else:
+                print("2. For GGUF conversion, install llama.cpp and follow instructions in gguf_conversion_info.json")
             print("3. Test the model with the validation scripts")
             print("=" * 60)
 
@@ -271,9 +432,6 @@ class SimpleGGUFConverter:
             print(f"❌ Conversion failed: {e}")
             return {"success": False, "error": str(e)}
 
-        finally:
-            self.cleanup()
-
 
 def main():
     """Main conversion function."""
@@ -4,15 +4,30 @@ CactusTTS Integration Test
 Tests trained models for compatibility with the existing Cactus infrastructure
 """
 
-import json
+import gc
+import importlib.util
 import os
+import shutil
 import sys
+import tempfile
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import torch
 from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+from _script_utils import dir_names, merged_cache_dir, read_json, set_cpu_threads, write_json
+
+BASE_MODEL_NAME = "microsoft/DialoGPT-medium"
+
+_BENCHMARK_PROMPT = "User: Tell me about this dungeon.\nDM:"
+
+
+def _weight_file_sizes(path: Path, suffixes=(".safetensors", ".bin")) -> Dict[str, int]:
+    """Map each weight file directly under path to its size, from a single scandir pass."""
+    with os.scandir(path) as it:
+        return {e.name: e.stat().st_size for e in it if e.name.endswith(suffixes) and e.is_file()}
 
 
 class CactusIntegrationTester:
@@ -23,6 +38,8 @@ class CactusIntegrationTester:
         self.model = None
         self.tokenizer = None
         self.cactus_config = None
+        self._eos_id = None
+        self._benchmark_input = None
 
     def load_cactus_config(self) -> bool:
         """Load the cactus configuration for the trained model."""
@@ -33,34 +50,87 @@ class CactusIntegrationTester:
             return False
 
         try:
-            with open(config_path, 'r') as f:
-                self.cactus_config = json.load(f)
+            self.cactus_config = read_json(config_path)
             print(f"✅ Loaded Cactus config: {self.cactus_config['model']['name']}")
             return True
         except Exception as e:
             print(f"❌ Failed to load Cactus config: {e}")
             return False
 
+    def _build_merged_cache(self, cache_dir: Path):
+        """Merge the adapter into the base model once and save it to the cache."""
+        print(f"🔀 Merging adapter into {BASE_MODEL_NAME} (cached for later runs)...")
+
+        # Stage next to the cache so it can be moved in atomically
+        cache_dir.parent.mkdir(parents=True, exist_ok=True)
+        staging_dir = Path(tempfile.mkdtemp(prefix="merged_model_", dir=cache_dir.parent))
+
+        try:
+            base_model = AutoModelForCausalLM.from_pretrained(
+                BASE_MODEL_NAME,
+                torch_dtype=torch.float16,  # Same layout convert_to_gguf.py caches
+                device_map={"": "cpu"},
+                low_cpu_mem_usage=True,
+            )
+            merged_model = PeftModel.from_pretrained(base_model, self.model_path).merge_and_unload()
+            del base_model
+            gc.collect()
+            merged_model.save_pretrained(staging_dir, safe_serialization=True, max_shard_size="2GB")
+            AutoTokenizer.from_pretrained(BASE_MODEL_NAME).save_pretrained(staging_dir)
+
+            if cache_dir.exists():
+                shutil.rmtree(cache_dir)
+            staging_dir.rename(cache_dir)
+
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
     def load_model(self) -> bool:
         """Load the trained model."""
         try:
             print(f"🔍 Loading model from {self.model_path}")
 
-            # Load base model and tokenizer
-            base_model_name = "microsoft/DialoGPT-medium"
-
-            base_model = AutoModelForCausalLM.from_pretrained(
-                base_model_name,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto" if torch.cuda.is_available() else None,
+            # The adapter is merged once and reloaded from an mmapped safetensors snapshot afterwards,
+            # so the tests run on fused weights without downloading or merging each time
+            cache_dir = merged_cache_dir(BASE_MODEL_NAME, self.model_path)
+            if {"config.json", "tokenizer_config.json"} <= dir_names(cache_dir):
+                print(f"♻️  Reusing cached merged model: {cache_dir}")
+            else:
+                self._build_merged_cache(cache_dir)
+
+            if torch.cuda.is_available() and importlib.util.find_spec("bitsandbytes"):
+                # NF4 weights approximate the quantized model shipped to devices
+                load_kwargs = {
+                    "quantization_config": BitsAndBytesConfig(
+                        load_in_4bit=True,
+                        bnb_4bit_quant_type="nf4",
+                        bnb_4bit_compute_dtype=torch.bfloat16,
+                        bnb_4bit_use_double_quant=True,
+                    ),
+                    "device_map": "auto",
+                }
+            elif torch.cuda.is_available():
+                load_kwargs = {"torch_dtype": torch.float16, "device_map": "auto"}
+            else:
+                load_kwargs = {"torch_dtype": torch.bfloat16}  # bitsandbytes needs CUDA
+                set_cpu_threads()
+
+            self.model = AutoModelForCausalLM.from_pretrained(
+                cache_dir,
+                low_cpu_mem_usage=True,
+                **load_kwargs,
             )
 
-            self.tokenizer = AutoTokenizer.from_pretrained(base_model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.tokenizer.padding_side = "left"  # Batched prompts must end where generation starts
+            self._eos_id = self.tokenizer.eos_token_id
+            self._benchmark_input = self.tokenizer.encode(_BENCHMARK_PROMPT, return_tensors="pt")
 
-            # Load the trained adapter
-            self.model = PeftModel.from_pretrained(base_model, self.model_path)
+            self.model.config.use_cache = True  # Gradient-checkpointed training leaves the KV cache off
+            self.model.eval()
 
             print("✅ Model loaded successfully!")
             return True
@@ -69,10 +139,8 @@ class CactusIntegrationTester:
             print(f"❌ Failed to load model: {e}")
             return False
 
-    def test_cactus_message_format(self) -> Dict[str, Any]:
-        """Test compatibility with Cactus message format."""
-        print("🧪 Testing Cactus message format compatibility...")
-
+    def _message_format_prompt(self) -> str:
+        """Build a Cactus-style system + user conversation in the model's prompt format."""
         # Simulate Cactus-style messages
         test_messages = [
             {
@@ -93,88 +161,81 @@ class CactusIntegrationTester:
             elif msg["role"] == "user":
                 formatted_prompt += f"User: {msg['content']}\n"
 
-        formatted_prompt += "DM:"
-
-        try:
-            # Generate response
-            inputs = self.tokenizer.encode(formatted_prompt, return_tensors="pt")
-
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs,
-                    max_length=inputs.shape[1] + 128,
-                    num_return_sequences=1,
-                    temperature=self.cactus_config["generation_config"]["temperature"],
-                    top_p=self.cactus_config["generation_config"]["top_p"],
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
-
-            response = self.tokenizer.decode(outputs[0][inputs.shape[1]:], skip_special_tokens=True)
+        return formatted_prompt + "DM:"
+
+    def _generate_batch(self, prompts: List[str], max_new_tokens: List[int]) -> List[str]:
+        """Generate for several prompts in one padded batch, truncating each row to its own budget."""
+        batch = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        prompt_len = batch["input_ids"].shape[1]
+
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                max_new_tokens=max(max_new_tokens),
+                use_cache=True,
+                temperature=self.cactus_config["generation_config"]["temperature"],
+                top_p=self.cactus_config["generation_config"]["top_p"],
+                do_sample=True,
+                pad_token_id=self._eos_id,
+                eos_token_id=self._eos_id,
+            )
 
-            return {
-                "success": True,
-                "prompt": formatted_prompt,
-                "response": response.strip(),
-                "response_length": len(response.strip())
-            }
+        return [
+            self.tokenizer.decode(outputs[i, prompt_len:prompt_len + limit], skip_special_tokens=True)
+            for i, limit in enumerate(max_new_tokens)
+        ]
 
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+    def test_generation_formats(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Test Cactus message format and tool call format compatibility in one batched generate call."""
+        print("🧪 Testing Cactus message format and tool call compatibility...")
 
-    def test_tool_call_format(self) -> Dict[str, Any]:
-        """Test tool call format compatibility."""
-        print("🔧 Testing tool call format...")
+        formatted_prompt = self._message_format_prompt()
 
         supported_tools = self.cactus_config["tools"]["supported"]
-        tool_format = self.cactus_config["tools"]["format"]
-
-        results = {
+        tool_results = {
             "supported_tools": supported_tools,
-            "expected_format": tool_format,
+            "expected_format": self.cactus_config["tools"]["format"],
             "test_results": []
         }
 
-        # Test each supported tool
-        for tool in supported_tools[:3]:  # Test first 3 tools
-            test_prompt = f"User: I want to use {tool}.\nDM:"
-
-            try:
-                inputs = self.tokenizer.encode(test_prompt, return_tensors="pt")
-
-                with torch.no_grad():
-                    outputs = self.model.generate(
-                        inputs,
-                        max_length=inputs.shape[1] + 64,
-                        num_return_sequences=1,
-                        temperature=0.7,
-                        do_sample=True,
-                        pad_token_id=self.tokenizer.eos_token_id,
-                    )
-
-                response = self.tokenizer.decode(outputs[0][inputs.shape[1]:], skip_special_tokens=True)
-
-                # Check if response contains expected tool format
-                has_tool_call = f"[{tool}:" in response or f"[{tool} " in response
-
-                results["test_results"].append({
-                    "tool": tool,
-                    "prompt": test_prompt,
-                    "response": response.strip(),
-                    "has_tool_call": has_tool_call
-                })
+        # Test the first 3 tools alongside the message format prompt
+        tools = supported_tools[:3]
+        tool_prompts = [f"User: I want to use {tool}.\nDM:" for tool in tools]
 
-            except Exception as e:
-                results["test_results"].append({
+        try:
+            responses = self._generate_batch(
+                [formatted_prompt] + tool_prompts,
+                [128] + [64] * len(tool_prompts)
+            )
+        except Exception as e:
+            for tool in tools:
+                tool_results["test_results"].append({
                     "tool": tool,
                     "error": str(e)
                 })
+            return {"success": False, "error": str(e)}, tool_results
+
+        response = responses[0].strip()
+        message_results = {
+            "success": True,
+            "prompt": formatted_prompt,
+            "response": response,
+            "response_length": len(response)
+        }
 
-        return results
+        for tool, test_prompt, response in zip(tools, tool_prompts, responses[1:]):
+            # Check if response contains expected tool format
+            has_tool_call = f"[{tool}:" in response or f"[{tool} " in response
+
+            tool_results["test_results"].append({
+                "tool": tool,
+                "prompt": test_prompt,
+                "response": response.strip(),
+                "has_tool_call": has_tool_call
+            })
+
+        return message_results, tool_results
 
     def test_memory_usage(self) -> Dict[str, Any]:
         """Test memory usage for mobile deployment."""
@@ -182,9 +243,8 @@ class CactusIntegrationTester:
 
         try:
             # Get model size information
-            model_files = list(self.model_path.glob("*.safetensors")) + list(self.model_path.glob("*.bin"))
-            total_size = sum(f.stat().st_size for f in model_files)
-            size_mb = total_size / (1024 * 1024)
+            model_files = _weight_file_sizes(self.model_path)
+            size_mb = sum(model_files.values()) / (1024 * 1024)
 
             # Check if under mobile limit (2GB as specified in requirements)
             mobile_limit_mb = 2048
@@ -194,7 +254,7 @@ class CactusIntegrationTester:
                 "model_size_mb": round(size_mb, 2),
                 "mobile_limit_mb": mobile_limit_mb,
                 "under_mobile_limit": under_limit,
-                "model_files": [f.name for f in model_files]
+                "model_files": list(model_files)
             }
 
         except Exception as e:
@@ -206,24 +266,22 @@ class CactusIntegrationTester:
         """Basic performance benchmark."""
         print("⚡ Running performance benchmark...")
 
-        test_prompt = "User: Tell me about this dungeon.\nDM:"
-
         try:
             import time
 
             # Warm up
-            inputs = self.tokenizer.encode(test_prompt, return_tensors="pt")
-            with torch.no_grad():
-                self.model.generate(inputs, max_length=inputs.shape[1] + 32)
+            inputs = self._benchmark_input
+            with torch.inference_mode():
+                self.model.generate(inputs, max_new_tokens=32, use_cache=True)
 
             # Benchmark
             start_time = time.time()
 
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = self.model.generate(
                     inputs,
-                    max_length=inputs.shape[1] + 128,
-                    num_return_sequences=1,
+                    max_new_tokens=128,
+                    use_cache=True,
                     temperature=0.7,
                     do_sample=True,
                 )
@@ -257,17 +315,28 @@ class CactusIntegrationTester:
         if not self.load_cactus_config():
             return {"error": "Failed to load Cactus config", "success": False}
 
+        # Check the on-disk size first so an oversized model fails before paying for a load
+        memory_test = self.test_memory_usage()
+        if memory_test.get("under_mobile_limit") is False:
+            return {
+                "error": f"Model size {memory_test['model_size_mb']} MB exceeds the "
+                         f"{memory_test['mobile_limit_mb']} MB mobile limit",
+                "success": False,
+                "memory_test": memory_test
+            }
+
         # Load model
         if not self.load_model():
             return {"error": "Failed to load model", "success": False}
 
         # Run tests
+        message_format_test, tool_call_test = self.test_generation_formats()
         results = {
             "model_path": str(self.model_path),
             "cactus_config": self.cactus_config,
-            "message_format_test": self.test_cactus_message_format(),
-            "tool_call_test": self.test_tool_call_format(),
-            "memory_test": self.test_memory_usage(),
+            "message_format_test": message_format_test,
+            "tool_call_test": tool_call_test,
+            "memory_test": memory_test,
             "performance_test": self.test_performance_benchmark()
         }
 
@@ -377,8 +446,7 @@ def main():
 
     # Save results
     results_file = script_dir / "trained_models/integration_test_results.json"
-    with open(results_file, 'w') as f:
-        json.dump(results, f, indent=2)
+    write_json(results_file, results)
 
     print(f"\n💾 Results saved to: {results_file}")
 